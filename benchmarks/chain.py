@@ -0,0 +1,85 @@
+"""
+Compares the memory usage and latency of the bot's MarkovChain with the old dict-of-lists implementation
+that was rebuilt from all stored words every time a phrase was made
+
+Chains of order 1 to 3 are measured, to show how memory grows with the order
+
+Usage: python -m benchmarks.chain [number of messages]
+"""
+import sys
+import time
+import random
+import tracemalloc
+
+from benchmarks.corpus import make_messages
+from talk_bot.markov.chain import MarkovChain
+
+
+def make_pairs(data):
+    for i in range(len(data) - 1):
+        yield (data[i], data[i + 1])
+
+
+def build_dict_of_lists(messages: list) -> tuple:
+    words = [word for message in messages for word in message.split(' ')]
+    word_dict = {}
+    for word_1, word_2 in make_pairs(words):
+        if word_1 in word_dict.keys():
+            word_dict[word_1].append(word_2)
+        else:
+            word_dict[word_1] = [word_2]
+    return words, word_dict
+
+
+def phrase_dict_of_lists(words: list, word_dict: dict, size: int = 30) -> str:
+    chain = [random.choice(words)]
+    for i in range(size):
+        chain.append(random.choice(word_dict.get(chain[-1]) or words))
+    return ' '.join(chain)
+
+
+def build_chain(messages: list, order: int = 2) -> MarkovChain:
+    chain = MarkovChain(order)
+    for message in messages:
+        chain.add(message)
+    return chain
+
+
+def measure(build, phrase, messages: list, phrases: int = 1_000) -> dict:
+    tracemalloc.start()
+    model = build(messages)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del model
+
+    start = time.perf_counter()
+    model = build(messages)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(phrases):
+        phrase(model)
+    phrase_time = (time.perf_counter() - start) / phrases
+    return {'build_s': build_time, 'memory_mb': memory / 2 ** 20, 'phrase_ms': phrase_time * 1000}
+
+
+def main(count: int = 200_000):
+    messages = list(make_messages(count))
+    tokens = sum(message.count(' ') + 1 for message in messages)
+    print(f'{count} messages, {tokens} words')
+    results = {
+        'dict of lists': measure(build_dict_of_lists, lambda model: phrase_dict_of_lists(*model), messages),
+    }
+    for order in (1, 2, 3):
+        results[f'order {order} chain'] = measure(
+            lambda messages: build_chain(messages, order), lambda model: model.make_phrase(), messages
+        )
+    for name, result in results.items():
+        print(f'{name:>15}: build {result["build_s"]:.2f}s, {result["memory_mb"]:.1f} MB, '
+              f'{result["phrase_ms"]:.3f} ms per phrase')
+    # The dict of lists was rebuilt from every stored word whenever a phrase was made
+    print(f'Making a phrase with the old implementation took {results["dict of lists"]["build_s"]:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,46 @@
+import random
+from itertools import accumulate
+
+USER_IDS = [546527580715745290 + i for i in range(1_000)]
+ROLE_IDS = [446527580715745290 + i for i in range(50)]
+
+
+def make_vocabulary(size: int, seed: int = 0) -> list:
+    """
+    Makes up a vocabulary of random lowercase words
+    """
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))))
+    return sorted(words)
+
+
+def make_mention(rng: random.Random) -> str:
+    kind = rng.random()
+    if kind < 0.8:
+        return f'<@{rng.choice(USER_IDS)}>'
+    if kind < 0.95:
+        return f'<@&{rng.choice(ROLE_IDS)}>'
+    return rng.choice(('@everyone', '@here'))
+
+
+def make_messages(count: int, vocabulary_size: int = 50_000, skew: float = 1.1, words_per_message: int = 12,
+                  mentions: float = 0.0, seed: int = 0):
+    """
+    Yields 'count' synthetic messages, with words drawn from a Zipf distribution (with exponent 'skew')
+    over a vocabulary of 'vocabulary_size' words, like the word frequencies of a real chat
+
+    Each word has a 'mentions' chance of being a mention to a user (see USER_IDS), a role (see ROLE_IDS),
+    @everyone or @here instead
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, seed)
+    cumulative = list(accumulate(1 / (rank ** skew) for rank in range(1, vocabulary_size + 1)))
+    for _ in range(count):
+        size = max(2, int(rng.expovariate(1 / words_per_message)))
+        words = rng.choices(vocabulary, cum_weights=cumulative, k=size)
+        if mentions:
+            words = [make_mention(rng) if rng.random() < mentions else word for word in words]
+        yield ' '.join(words)
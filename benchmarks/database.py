@@ -0,0 +1,50 @@
+import os
+import json
+import datetime
+
+from benchmarks.corpus import make_messages
+
+
+def use_sqlite(directory: str) -> str:
+    """
+    Points the bot's database to a new Sqlite database in 'directory', must be called before talk_bot.orm.models
+    is imported (also by worker processes, which inherit the environment variable)
+
+    Returns the path of the database file
+    """
+    path = os.path.join(directory, 'benchmark.db')
+    credentials_path = os.path.join(directory, 'db_credentials.json')
+    with open(credentials_path, 'w') as f:
+        json.dump({'sqlite': path}, f)
+    os.environ['TALK_BOT_DB_CREDENTIALS'] = credentials_path
+    return path
+
+
+def fill(count: int, channels: int = 10, batch_size: int = 1_000, normalized: bool = False, **kwargs):
+    """
+    Creates the bot's tables and stores 'count' synthetic messages (see make_messages) in them, spread over
+    'channels' channels, as tokens if 'normalized' (see talk_bot.orm.tokens)
+    """
+    from talk_bot.orm import migrations, tokens
+    from talk_bot.orm.models import db, Message
+
+    migrations.migrate_database()
+    timestamp = datetime.datetime(2019, 1, 1)
+    with db.connection_context():
+        rows = []
+        for i, content in enumerate(make_messages(count, **kwargs)):
+            rows.append({
+                'message_id': i + 1,
+                'content': content,
+                'author_name': 'user',
+                'author_id': i % 100,
+                'channel_id': i % channels + 1,
+                'timestamp': timestamp
+            })
+            if len(rows) == batch_size:
+                with db.atomic():
+                    Message.insert_many(tokens.normalize(rows) if normalized else rows).execute()
+                rows = []
+        if rows:
+            with db.atomic():
+                Message.insert_many(tokens.normalize(rows) if normalized else rows).execute()
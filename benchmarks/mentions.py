@@ -0,0 +1,111 @@
+"""
+Compares the cost of cleaning mention-heavy messages with the bot's MentionRewriter and with the old
+implementation of Bot.clean_message, which ran a separate search and replace for every mention
+
+Usage: python -m benchmarks.mentions [number of messages] [chance of each word being a mention]
+"""
+import re
+import sys
+import time
+
+from benchmarks.corpus import USER_IDS, ROLE_IDS, make_messages
+from talk_bot.mentions import MentionRewriter
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.display_name = f'user{user_id % 1000}'
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.name = f'role{role_id % 1000}'
+
+
+class FakeGuild:
+    def __init__(self):
+        self.roles = {role_id: FakeRole(role_id) for role_id in ROLE_IDS}
+
+    def get_role(self, role_id: int):
+        return self.roles.get(role_id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.guild = FakeGuild()
+
+
+class FakeBot:
+    """
+    Just enough of the bot for cleaning messages, with every user of USER_IDS but the last 100 known to it
+    """
+
+    def __init__(self):
+        self.users = {user_id: FakeUser(user_id) for user_id in USER_IDS[:-100]}
+        self.channel = FakeChannel(1)
+
+    def get_user(self, user_id: int):
+        return self.users.get(user_id)
+
+    def get_channel(self, channel_id: int):
+        return self.channel
+
+    def add_listener(self, function, name: str):
+        pass
+
+
+def old_clean_message(bot: FakeBot, content: str, channel_id: int) -> str:
+    user_mentions = re.findall(r'(<@\d+>)', content)
+    for mention in user_mentions:
+        user_id = re.search(r'\d+', mention)
+        user_id = user_id.group()
+        user = bot.get_user(int(user_id))
+        if user:
+            content = content.replace(mention, user.display_name)
+        else:
+            content = content.replace(mention, '')
+
+    role_mentions = re.findall(r'(<@&\d+>)', content)
+    for mention in role_mentions:
+        role_id = re.search(r'\d+', mention)
+        role_id = role_id.group()
+        channel = bot.get_channel(channel_id)
+        guild = channel.guild
+        role = guild.get_role(int(role_id))
+        if role:
+            content = content.replace(mention, role.name)
+        else:
+            content = content.replace(mention, '')
+
+    content = content.replace('@everyone', '`@everyone`')
+    content = content.replace('@here', '`@here`')
+
+    return content
+
+
+def measure(clean, messages: list) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        clean(message, 1)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def main(count: int = 100_000, mentions: float = 0.1):
+    messages = list(make_messages(count, mentions=mentions))
+    bot = FakeBot()
+    rewriter = MentionRewriter(bot)
+    for message in messages[:1_000]:
+        assert rewriter.clean(message, 1) == old_clean_message(bot, message, 1)
+
+    old = measure(lambda content, channel_id: old_clean_message(bot, content, channel_id), messages)
+    new = measure(rewriter.clean, messages)
+    print(f'{count} messages, {mentions:.0%} of words are mentions')
+    print(f'old clean_message: {old * 1e6:.2f} us per message')
+    print(f'  MentionRewriter: {new * 1e6:.2f} us per message ({old / new:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*(float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]))
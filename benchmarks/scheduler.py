@@ -0,0 +1,111 @@
+"""
+Drives the send scheduler (see talk_bot.tasks.scheduler) with bursts of messages to fake channels that fail now and
+then, and reports how long messages waited and the most messages a channel was sent within its bucket's window (the
+tests in tests/test_scheduler.py assert that the bucket holds)
+
+Messages are about 600 characters long, so at most three of them are coalesced into a single Discord message.
+Time is scaled down ten times: the scheduler's bucket is 5 messages every 0.5 seconds instead of every 5 seconds
+
+Usage: python -m benchmarks.scheduler [channels] [messages per channel]
+"""
+import sys
+import time
+import random
+import asyncio
+from collections import defaultdict
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = 'Fake error'
+
+
+class FakeTextChannel:
+    """
+    Just enough of a discord.TextChannel to send messages to, records when they were sent and fails 'failure_rate'
+    of the sends with a Discord server error
+    """
+
+    def __init__(self, channel_id: int, latency: float = 0.005, failure_rate: float = 0.02):
+        self.id = channel_id
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+        self.failures = 0
+
+    async def send(self, content: str = None, embed=None):
+        import discord
+
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise discord.HTTPException(FakeResponse(500), 'Internal Server Error')
+        self.sent.append((time.perf_counter(), content))
+        return content
+
+
+def max_in_window(times: list, window: float) -> int:
+    """
+    Most messages sent within any 'window' seconds
+    """
+    most = start = 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= window:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+
+async def run(channels: int, messages: int) -> dict:
+    from talk_bot.tasks.scheduler import SendScheduler
+
+    scheduler = SendScheduler(rate=5, per=0.5, jitter=0.1, idle_timeout=1)
+    fake_channels = [FakeTextChannel(i + 1) for i in range(channels)]
+    latencies = defaultdict(list)
+
+    async def send(channel: FakeTextChannel, priority: int, content: str):
+        start = time.perf_counter()
+        try:
+            await scheduler.send(channel, content, priority=priority)
+        except Exception:
+            return
+        latencies[priority].append(time.perf_counter() - start)
+
+    sends = []
+    for i in range(messages):
+        for channel in fake_channels:
+            sends.append(send(channel, SendScheduler.CHATTER, f'chatter {i} ' + 'x' * 600))
+            if i % 10 == 0:
+                sends.append(send(channel, SendScheduler.ERROR, f'error {i} ' + 'x' * 600))
+    start = time.perf_counter()
+    await asyncio.gather(*sends)
+    elapsed = time.perf_counter() - start
+    scheduler.shutdown()
+
+    return {
+        'elapsed_s': elapsed,
+        'messages': len(sends),
+        'sent': sum(len(channel.sent) for channel in fake_channels),
+        'failures': sum(channel.failures for channel in fake_channels),
+        'max_per_window': max(max_in_window([t for t, _ in channel.sent], 0.5) for channel in fake_channels),
+        'latency_ms': {
+            priority: sum(values) / len(values) * 1000 for priority, values in sorted(latencies.items()) if values
+        }
+    }
+
+
+def main(channels: int = 50, messages: int = 40):
+    from talk_bot.tasks.scheduler import SendScheduler
+
+    results = asyncio.get_event_loop().run_until_complete(run(channels, messages))
+    names = {SendScheduler.ERROR: 'error', SendScheduler.COMMAND: 'command', SendScheduler.CHATTER: 'chatter'}
+    print(f'{results["messages"]} messages to {channels} channels in {results["elapsed_s"]:.2f}s, sent as '
+          f'{results["sent"]} Discord messages ({results["failures"]} server errors retried)')
+    print(f'Most messages sent to a channel within its bucket window: {results["max_per_window"]} (limit 5)')
+    for priority, latency in results['latency_ms'].items():
+        print(f'{names[priority]:>8}: waited {latency:.1f} ms on average')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""
+Compares storing messages as text with storing them as tokens (see talk_bot.orm.tokens): the size of the database
+and how long it takes to train a Markov chain from all messages
+
+Uses a temporary Sqlite database, filled with synthetic messages
+
+Usage: python -m benchmarks.storage [number of messages]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from benchmarks.database import use_sqlite, fill
+
+
+def measure(database: str, directory: str, count: int, normalized: bool) -> dict:
+    from talk_bot.markov import training
+    from talk_bot.orm import migrations, tokens
+    from talk_bot.orm.models import db, Message, Token
+
+    migrations.migrate_database()
+    with db.connection_context():
+        Message.delete().execute()
+        Token.delete().execute()
+    tokens.ids.clear()
+    tokens.words.clear()
+    fill(count, normalized=normalized)
+    with db.connection_context():
+        db.execute_sql('VACUUM')
+    size = os.path.getsize(database)
+
+    path = os.path.join(directory, f'{normalized}.snapshot')
+    start = time.perf_counter()
+    words, watermark = training.train(path, 1, 2)
+    return {'size_mb': size / 2 ** 20, 'words': words, 'train_s': time.perf_counter() - start}
+
+
+def main(count: int = 200_000):
+    with tempfile.TemporaryDirectory() as directory:
+        database = use_sqlite(directory)
+        results = {
+            'text': measure(database, directory, count, normalized=False),
+            'tokens': measure(database, directory, count, normalized=True)
+        }
+    print(f'{count} messages')
+    for name, result in results.items():
+        print(f'{name:>6}: database of {result["size_mb"]:.1f} MB, chain of {result["words"]} words trained in '
+              f'{result["train_s"]:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
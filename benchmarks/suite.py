@@ -0,0 +1,231 @@
+"""
+Benchmarks the bot's hot paths offline, against a temporary Sqlite database filled with synthetic messages (see
+benchmarks.corpus), for every number of messages given
+
+For every corpus size it measures:
+    - store_history: messages stored per second from pages of channel history, like populate_db does
+    - add_message: messages received per second, including buffering, learning and inserting them
+    - clean_message: microseconds to clean a message
+    - clean_db: seconds to clean the whole database
+    - make_phrase: milliseconds to make a phrase, and the time and memory to build the chain
+
+Results are printed and, with --output, written as JSON so runs can be compared
+
+Usage: python -m benchmarks.suite [--output results.json] [--skew 1.1] [--mentions 0.02] [sizes...]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+
+from benchmarks.corpus import make_messages
+from benchmarks.database import use_sqlite
+
+# Messages of a channel's history stored at a time, like talk_bot.tasks.backfill does
+PAGE_SIZE = 100
+# Messages received in a row before the event loop gets to run the buffer's flushes
+RECEIVE_BURST = 100
+
+
+class FakeAuthor:
+    def __init__(self, author_id: int):
+        self.id = author_id
+        self.name = f'user{author_id}'
+        self.bot = False
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+    @staticmethod
+    def is_nsfw() -> bool:
+        return False
+
+
+class FakeMessage:
+    """
+    Just enough of a discord.Message for Bot.add_message
+    """
+
+    def __init__(self, message_id: int, content: str, channel: FakeChannel, author: FakeAuthor):
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.created_at = datetime.datetime(2019, 1, 1)
+
+
+def make_bot(directory: str):
+    from talk_bot.bot import Bot
+    from talk_bot.orm.models import db, Message, BackfillCursor
+
+    with db.connection_context():
+        for model in (Message, BackfillCursor):
+            if model.table_exists():
+                model.delete().execute()
+    return Bot({
+        'prefix': '!',
+        'outputs': [{'scope': 'global', 'channel': 1, 'delay': 5}],
+        'snapshot_dir': os.path.join(directory, 'snapshots'),
+    })
+
+
+async def bench_store_history(bot, rows: list) -> dict:
+    start = time.perf_counter()
+    for i in range(0, len(rows), PAGE_SIZE):
+        await bot.store_history(rows[i:i + PAGE_SIZE])
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'messages_per_s': len(rows) / elapsed}
+
+
+async def bench_add_message(bot, messages: list) -> dict:
+    start = time.perf_counter()
+    for i, message in enumerate(messages):
+        bot.add_message(message)
+        if i % RECEIVE_BURST == RECEIVE_BURST - 1:
+            await asyncio.sleep(0)
+    await bot.message_buffer.flush()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'messages_per_s': len(messages) / elapsed}
+
+
+def bench_clean_message(bot, contents: list) -> dict:
+    start = time.perf_counter()
+    for content in contents:
+        bot.clean_message(content, 1)
+    elapsed = time.perf_counter() - start
+    return {'us_per_message': elapsed / len(contents) * 1e6}
+
+
+async def bench_clean_db(bot) -> dict:
+    start = time.perf_counter()
+    checked, deleted, updated = await bot.clean_db()
+    return {'seconds': time.perf_counter() - start, 'checked': checked, 'deleted': deleted, 'updated': updated}
+
+
+def bench_make_phrase(contents: list, order: int = 1, phrases: int = 1_000) -> dict:
+    from talk_bot.markov.chain import MarkovChain
+
+    def build() -> MarkovChain:
+        chain = MarkovChain(order)
+        for content in contents:
+            chain.add(content)
+        return chain
+
+    tracemalloc.start()
+    chain = build()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del chain
+
+    # Built again for the time, tracing memory makes building much slower
+    start = time.perf_counter()
+    chain = build()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(phrases):
+        chain.make_phrase()
+    phrase_time = (time.perf_counter() - start) / phrases
+    return {
+        'order': order, 'words': len(chain), 'build_s': build_time, 'memory_mb': memory / 2 ** 20,
+        'phrase_ms': phrase_time * 1000
+    }
+
+
+async def bench_size(directory: str, count: int, skew: float, mentions: float, channels: int = 10) -> dict:
+    contents = list(make_messages(count, skew=skew, mentions=mentions))
+    bot = make_bot(os.path.join(directory, str(count)))
+    try:
+        history = [
+            {
+                'message_id': i + 1,
+                'content': bot.clean_message(content, 1),
+                'author_name': 'user',
+                'author_id': i % 100,
+                'channel_id': i % channels + 1,
+                'timestamp': datetime.datetime(2019, 1, 1)
+            }
+            for i, content in enumerate(contents)
+        ]
+        results = {'store_history': await bench_store_history(bot, history)}
+
+        # New messages are learned by the loaded chain as they are received
+        await bot.chains.get('global')
+        received = min(count, 100_000)
+        channel_list = [FakeChannel(i + 1) for i in range(channels)]
+        authors = [FakeAuthor(i) for i in range(100)]
+        messages = [
+            FakeMessage(count + i + 1, content, channel_list[i % channels], authors[i % 100])
+            for i, content in enumerate(contents[:received])
+        ]
+        results['add_message'] = await bench_add_message(bot, messages)
+        results['clean_message'] = bench_clean_message(bot, contents)
+        results['clean_db'] = await bench_clean_db(bot)
+        results['make_phrase'] = bench_make_phrase(contents)
+    finally:
+        bot.trainer.shutdown()
+        bot.db_executor.shutdown()
+    return results
+
+
+def cancel_tasks(loop: asyncio.AbstractEventLoop):
+    """
+    Cancels the background tasks of the bots, they wait forever for the bot to connect to Discord
+    """
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    tasks = all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the bot against Sqlite')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10_000, 100_000], help='numbers of messages')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the word frequencies')
+    parser.add_argument('--mentions', type=float, default=0.02, help='chance of each word being a mention')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_sqlite(directory)
+        from talk_bot.orm import migrations
+        migrations.migrate_database()
+
+        loop = asyncio.get_event_loop()
+        results = {
+            'python': platform.python_version(),
+            'skew': args.skew,
+            'mentions': args.mentions,
+            'sizes': {}
+        }
+        for count in args.sizes:
+            results['sizes'][count] = size_results = loop.run_until_complete(
+                bench_size(directory, count, args.skew, args.mentions)
+            )
+            cancel_tasks(loop)
+            print(f'{count} messages')
+            print(f'  store_history: {size_results["store_history"]["messages_per_s"]:.0f} messages/s')
+            print(f'    add_message: {size_results["add_message"]["messages_per_s"]:.0f} messages/s')
+            print(f'  clean_message: {size_results["clean_message"]["us_per_message"]:.2f} us per message')
+            print(f'       clean_db: {size_results["clean_db"]["seconds"]:.2f}s')
+            make_phrase = size_results['make_phrase']
+            print(f'    make_phrase: {make_phrase["phrase_ms"]:.3f} ms per phrase, chain built in '
+                  f'{make_phrase["build_s"]:.2f}s using {make_phrase["memory_mb"]:.1f} MB')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+"""
+Measures how long the event loop is blocked while a Markov chain is built from a large number of stored messages,
+when it's built on the event loop and when it's built by a Trainer worker process
+
+Uses a temporary Sqlite database, filled with synthetic messages
+
+Usage: python -m benchmarks.training [number of messages]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+from benchmarks.database import use_sqlite, fill
+
+
+async def watch_loop(lags: list, stop: asyncio.Event, interval: float = 0.01):
+    """
+    Records how late the event loop wakes up from every sleep of 'interval' seconds until 'stop' is set
+    """
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def measure(train) -> dict:
+    lags = []
+    stop = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_loop(lags, stop))
+    start = time.perf_counter()
+    words = await train()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await watcher
+    return {'words': words, 'train_s': elapsed, 'max_lag_ms': max(lags) * 1000, 'ticks': len(lags)}
+
+
+async def run(directory: str) -> dict:
+    from talk_bot.markov import snapshot
+    from talk_bot.markov.chain import MarkovChain
+    from talk_bot.markov.training import Trainer
+    from talk_bot.orm import corpus
+    from talk_bot.orm.executor import DatabaseExecutor
+
+    db_executor = DatabaseExecutor()
+    trainer = Trainer()
+
+    async def on_event_loop():
+        # What loading a chain without a trainer does
+        rows = await db_executor.run(lambda: list(corpus.read_messages()))
+        chain = MarkovChain()
+        for message_id, content in rows:
+            chain.add(content, message_id)
+        return len(chain)
+
+    async def in_worker():
+        path = os.path.join(directory, 'global.snapshot')
+        words, watermark = await trainer.train(path, 1, 2)
+        snapshot.load(path)
+        return words
+
+    try:
+        return {'event loop': await measure(on_event_loop), 'worker process': await measure(in_worker)}
+    finally:
+        trainer.shutdown()
+        db_executor.shutdown()
+
+
+def main(count: int = 200_000):
+    with tempfile.TemporaryDirectory() as directory:
+        use_sqlite(directory)
+        fill(count)
+        results = asyncio.get_event_loop().run_until_complete(run(directory))
+    print(f'{count} messages')
+    for name, result in results.items():
+        print(f'{name:>15}: {result["words"]} words in {result["train_s"]:.2f}s, '
+              f'event loop blocked for up to {result["max_lag_ms"]:.1f} ms ({result["ticks"]} ticks of 10 ms)')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,36 @@
+import math
+import hashlib
+
+
+class BloomFilter:
+    """
+    Compact set of strings that can only tell if a string was probably added to it
+
+    Strings that were added are always found, strings that were not are wrongly found at most 'error_rate' of the
+    time while at most 'capacity' strings were added (more often past that). Every string only takes about
+    10 bits at a 1% error rate, no matter its length, and strings can't be removed
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, text: str):
+        # Double hashing: the positions are h1 + i * h2, from the two halves of a single hash
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, text: str):
+        for position in self.positions(text):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, text: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(text))
@@ -1,16 +1,31 @@
-import re
 import sys
 import json
+import time
 import asyncio
 import logging
 import datetime
+import functools
 from pathlib import Path
 
 import discord
+import peewee
 from discord.ext import commands
 
+from talk_bot import metrics
+from talk_bot.bloom import BloomFilter
+from talk_bot.filters import MessageFilter
+from talk_bot.markov.chain import tokenize
+from talk_bot.markov.partitions import ChainPartitions, parse_scope
+from talk_bot.markov.training import Trainer
+from talk_bot.mentions import MentionRewriter
+from talk_bot.orm.executor import DatabaseExecutor
+from talk_bot.orm import corpus, migrations, storage, tokens
 from talk_bot.orm.models import db, Message, IgnoredChannel
-from talk_bot.tasks.sender import send_messages
+from talk_bot.orm.retention import RetentionPolicy
+from talk_bot.tasks.backfill import Backfill
+from talk_bot.tasks.ingestion import MessageBuffer
+from talk_bot.tasks.scheduler import SendScheduler
+from talk_bot.tasks.sender import PhraseBuffer, send_messages
 
 
 def load_settings() -> dict:
@@ -29,11 +44,70 @@ class Bot(commands.Bot):
         self.settings = settings
         self.start_time = None
         self.app_info = None
-
+        self.metrics_runner = None
+        # Seconds taken by every phase of the bot's startup, printed once it's ready
+        self.startup_timings = {}
+        self.connect_start = None
+        self.ready_once = False
+        self.normalized = bool(settings.get('normalized_storage', False))
+        self.outputs = self.load_outputs()
+        self.trainer = Trainer(workers=int(settings.get('training_workers', 1)))
+        self.chains = ChainPartitions(
+            self,
+            scopes=[scope for scope, channel_id, delay in self.outputs],
+            order=int(settings.get('chain_order', 1)),
+            backoff=int(settings.get('chain_backoff', 2)),
+            snapshot_dir=settings.get('snapshot_dir', 'snapshots'),
+            word_budget=int(settings.get('partition_word_budget', 2_000_000)),
+            trainer=self.trainer,
+            train_timeout=60 * float(settings.get('training_timeout', 30))
+        )
+        self.copies = BloomFilter(int(settings.get('copy_filter_capacity', 2_000_000)))
+        self.phrases = {
+            scope: PhraseBuffer(
+                self.chains,
+                scope,
+                size=int(settings.get('phrase_buffer_size', 10)),
+                min_words=int(settings.get('phrase_min_words', 3)),
+                copies=self.copies
+            )
+            for scope in self.chains.scopes
+        }
+        self.mentions = MentionRewriter(self)
+        self.scheduler = SendScheduler(jitter=float(settings.get('send_jitter', 0.1)))
+        self.db_executor = DatabaseExecutor(
+            pool_size=int(settings.get('db_pool_size', 4)),
+            queue_depth=int(settings.get('db_queue_depth', 100))
+        )
+        self.message_buffer = MessageBuffer(
+            self.db_executor,
+            max_size=int(settings.get('ingest_batch_size', 100)),
+            max_delay=float(settings.get('ingest_flush_delay', 5)),
+            max_backlog=int(settings.get('ingest_max_backlog', 10_000)),
+            normalized=self.normalized
+        )
+        self.backfill = Backfill(
+            self,
+            concurrency=int(settings.get('backfill_concurrency', 4)),
+            limit=int(settings.get('backfill_limit', 5_000))
+        )
+
+        start = time.perf_counter()
         self.db_setup()
+        self.message_filter = MessageFilter(settings.get('prefix'), ignored_channels=self.load_ignored_channels())
+        self.startup_timings['database'] = time.perf_counter() - start
         self.remove_command('help')
         self.loop.create_task(self.track_start())
-        self.loop.create_task(self.load_all_extensions())
+        self.loop.create_task(self.save_chain_periodically())
+        self.retention = RetentionPolicy.from_settings(settings)
+        if self.retention:
+            self.loop.create_task(self.compact_periodically())
+        self.loop.create_task(self.load_copies())
+        self.loop.create_task(self.fill_phrases())
+        self.loop.create_task(metrics.watch_loop_lag())
+        self.register_metrics()
+        if settings.get('metrics_port'):
+            self.loop.create_task(self.serve_metrics())
 
     async def track_start(self):
         """
@@ -42,17 +116,49 @@ class Bot(commands.Bot):
         await self.wait_until_ready()
         self.start_time = datetime.datetime.utcnow()
 
+    async def start(self, *args, **kwargs):
+        """
+        Loads the chains of the bot's outputs and its extensions, at the same time, then connects to Discord
+        """
+        # Chains go first, so their snapshots are read while the extensions are imported
+        await asyncio.gather(
+            self.time_phase('chains', self.load_chains()),
+            self.time_phase('extensions', self.load_all_extensions())
+        )
+        self.connect_start = time.perf_counter()
+        await super().start(*args, **kwargs)
+
+    async def time_phase(self, phase: str, coroutine):
+        """
+        Awaits a phase of the bot's startup, recording how long it took in Bot.startup_timings
+        """
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.startup_timings[phase] = time.perf_counter() - start
+
+    async def load_chains(self):
+        """
+        Loads the chains of the bot's outputs, but the ones of guilds: the channels of a guild are only known once
+        the bot is connected, they are loaded when their first phrase is made. Chains that fail to load are also
+        loaded again when their first phrase is made
+        """
+        scopes = [scope for scope in self.chains.scopes if not scope.startswith('guild:')]
+        results = await asyncio.gather(*(self.chains.get(scope) for scope in scopes), return_exceptions=True)
+        for scope, result in zip(scopes, results):
+            if isinstance(result, Exception):
+                logging.error(f'Failed to load the Markov chain of {scope}', exc_info=result)
+
     async def load_all_extensions(self):
         """
-        Attempts to load all .py files in /cogs/ as cog extensions
+        Attempts to load all .py files in talk_bot/cogs/ as cog extensions
         """
-        await self.wait_until_ready()
-        await asyncio.sleep(1)  # ensure that on_ready has completed and finished printing
         disabled = ['__init__']
-        cogs = [x.stem for x in Path('cogs').glob('*.py') if x.stem not in disabled]
-        for extension in cogs:
+        cogs = [x.stem for x in (Path(__file__).parent / 'cogs').glob('*.py') if x.stem not in disabled]
+        for extension in sorted(cogs):
             try:
-                self.load_extension(f'cogs.{extension}')
+                self.load_extension(f'talk_bot.cogs.{extension}')
                 print(f'Loaded extension: {extension}')
             except Exception as e:
                 error = f'{extension}\n {type(e).__name__} : {e}'
@@ -62,6 +168,8 @@ class Bot(commands.Bot):
     async def on_ready(self):
         """
         This event is called every time the bot connects or resumes connection.
+
+        The output channels are only started and the history of all channels only downloaded the first time
         """
         print('-' * 10)
         self.app_info = await self.application_info()
@@ -71,23 +179,28 @@ class Bot(commands.Bot):
               f'Prefix: {self.settings.get("prefix")}\n'
               f'Template Maker: SourSpoon / Spoon#7805')
         print('-' * 10)
-        try:
-            channel = self.get_channel(int(self.settings.get('messages_channel')))
-        except (TypeError, ValueError):
-            print(f'Error: Invalid messages channel: {self.settings.get("messages_channel")}')
-            sys.exit(1)
-        try:
-            delay = int(self.settings.get('messages_delay'))
-        except (TypeError, ValueError):
-            print(f'Error: Invalid messages delay: {self.settings.get("messages_delay")}')
-            sys.exit(1)
-        self.loop.create_task(send_messages(channel, delay))
+        if self.ready_once:
+            return
+        self.ready_once = True
+        self.startup_timings['connect'] = time.perf_counter() - self.connect_start
+        print('Started in ' + ', '.join(f'{seconds:.2f}s ({phase})' for phase, seconds in self.startup_timings.items()))
+        for scope, channel_id, delay in self.outputs:
+            channel = self.get_channel(channel_id)
+            if channel is None:
+                print(f'Error: Invalid messages channel: {channel_id}')
+                sys.exit(1)
+            self.scheduler.supervise(
+                f'Sender of channel {channel_id}',
+                functools.partial(send_messages, self.scheduler, channel, self.phrases[scope], delay)
+            )
         await self.populate_db()
 
+    @metrics.ON_MESSAGE.time()
     async def on_message(self, message: discord.Message):
         """
         This event triggers on every message received by the bot
         """
+        metrics.MESSAGES_RECEIVED.inc()
         if message.author.bot:
             return  # Ignore all bot messages
         # Only allow messages sent on a guild
@@ -97,7 +210,8 @@ class Bot(commands.Bot):
 
     async def send_logs(self, e: Exception, tb: str, ctx: commands.Context = None):
         """
-        Sends logs of errors to the bot's instance owner as a private Discord message
+        Sends logs of errors to the bot's instance owner as a private Discord message, ahead of any other message
+        waiting to be sent to them (see talk_bot.tasks.scheduler)
         """
         owner = self.app_info.owner
         separator = ("_\\" * 15) + "_"
@@ -108,76 +222,114 @@ class Bot(commands.Bot):
             info_embed.add_field(name="By", value=ctx.author, inline=False)
             info_embed.add_field(name="In Guild", value=ctx.guild, inline=False)
             info_embed.add_field(name="In Channel", value=ctx.channel, inline=False)
+        error = SendScheduler.ERROR
         try:
-            await owner.send(content=f"{separator}\n**{e}:**\n```python\n{tb}```", embed=info_embed)
+            await self.scheduler.send(
+                owner, f"{separator}\n**{e}:**\n```python\n{tb}```", embed=info_embed, priority=error
+            )
         except discord.errors.HTTPException:
             logging.error(f"{e}: {tb}")
             try:
-                await owner.send(
-                    content=f"(Sending first 500 chars of traceback, too long)\n{separator}\n**{e}:**"
+                await self.scheduler.send(
+                    owner,
+                    f"(Sending first 500 chars of traceback, too long)\n{separator}\n**{e}:**"
                     f"\n```python\n{tb[:500]}```",
-                    embed=info_embed
+                    embed=info_embed,
+                    priority=error
                 )
             except Exception:
-                await owner.send(content="Error trying to send error logs.", embed=info_embed)
+                await self.scheduler.send(owner, "Error trying to send error logs.", embed=info_embed, priority=error)
 
-    def clean_db(self):
+    @metrics.CLEAN_DB.time()
+    async def clean_db(self, progress=None) -> tuple:
         """
-        Removes all Messages from DB that were sent by a Bot or in a NSFW channel and calls
-        Bot.format_message() on the message's content to check for anything else that's wrong
+        Removes all Messages from DB that were sent by a Bot, in a NSFW channel or in a channel that is now ignored
+        (or that are not valid anymore for any other reason, see MessageFilter) and calls Bot.clean_message() on the
+        message's content to check for anything else that's wrong
 
-        TODO: Refactor this to be non-blocking, currently blocks the bot for ~3 minutes with 17k messages in the DB
+        Messages are read in batches of 'clean_batch_size' (1000 by default) ordered by id, and each batch is
+        checked, deleted and updated in a worker thread so the bot keeps running while the database is cleaned.
+        Every message deleted or changed is also removed from or updated in the bot's Markov chains
+
+        'progress' is awaited after every batch with the number of messages checked, deleted and updated so far,
+        the same numbers are returned once the whole database was cleaned
+        """
+        batch_size = int(self.settings.get('clean_batch_size', 1000))
+        nsfw_channels = {
+            channel.id for channel in self.get_all_channels()
+            if isinstance(channel, discord.TextChannel) and channel.is_nsfw()
+        }
+        bot_users = {user.id for user in self.users if user.bot}
+
+        last_id = 0
+        checked = deleted = updated = 0
+        while True:
+            async with self.chains.lock:
+                batch = await self.db_executor.run(
+                    self.clean_batch, last_id, batch_size, nsfw_channels, bot_users
+                )
+                if batch is None:
+                    break
+                last_id, batch_checked, deleted_messages, updated_messages = batch
+                for channel_id, content in deleted_messages:
+                    self.chains.remove(channel_id, content)
+                for channel_id, old_content, new_content in updated_messages:
+                    self.chains.remove(channel_id, old_content)
+                    self.chains.add(channel_id, new_content)
+            checked += batch_checked
+            deleted += len(deleted_messages)
+            updated += len(updated_messages)
+            if progress:
+                await progress(checked, deleted, updated)
+        return checked, deleted, updated
+
+    def clean_batch(self, after_id: int, batch_size: int, nsfw_channels: set, bot_users: set):
         """
-        for message in Message.select():
-            channel = self.get_channel(message.channel_id)
+        Cleans the next 'batch_size' messages with an id higher than 'after_id', see Bot.clean_db()
 
-            # Deletes message from database if it was sent in a channel that is now ignored
-            ignored_channel = Message.select().where(Message.channel_id == channel.id)
-            if ignored_channel:
-                message.delete()
+        Returns None if there are no messages left, otherwise the id of the last message checked, the number of
+        messages checked, the channel id and content of the deleted messages and the channel id and old and new
+        content of the updated ones
+        """
+        rows = corpus.read_batch(
+            Message.channel_id, Message.author_id, Message.content, key=Message.id, after=after_id, batch_size=batch_size
+        )
+        if not rows:
+            return None
+
+        to_delete = {}
+        to_update = {}
+        for message_id, channel_id, author_id, content in rows:
+            if not self.message_filter.is_valid_stored(channel_id, author_id, content, nsfw_channels, bot_users):
+                to_delete[message_id] = (channel_id, content)
                 continue
+            cleaned = self.clean_message(content, channel_id)
+            if cleaned != content:
+                to_update[message_id] = (channel_id, content, cleaned)
 
-            # Deletes message if it was sent in a nsfw channel
-            if channel:
-                if channel.is_nsfw():
-                    Message.delete().where(Message.channel_id == channel.id)
-                    continue
-
-            message.content = self.clean_message(message.content, message.channel_id)
-            message.save()
-            author = self.get_user(message.author_id)
-
-            # Deletes message if it was sent by a bot
-            if author:
-                if author.bot:
-                    Message.delete().where(Message.author_id == author.id)
+        with db.atomic():
+            if to_delete:
+                Message.delete().where(Message.id.in_(list(to_delete))).execute()
+            if to_update:
+                updates = [{'content': new} for channel_id, old, new in to_update.values()]
+                updates = tokens.normalize(updates) if self.normalized else updates
+                new_content = peewee.Case(Message.id, [(i, row['content']) for i, row in zip(to_update, updates)])
+                new_tokens = None
+                # A CASE of only NULLs would be text, that Postgres refuses to store in a bytea column
+                if any(row.get('tokens') for row in updates):
+                    new_tokens = peewee.Case(Message.id, [(i, row['tokens']) for i, row in zip(to_update, updates)])
+                Message.update(content=new_content, tokens=new_tokens).where(
+                    Message.id.in_(list(to_update))
+                ).execute()
+        return rows[-1][0], len(rows), list(to_delete.values()), list(to_update.values())
 
     def is_valid_message(self, message: discord.Message) -> bool:
         """
-        Checks if a message is valid to be put in the bot's database
-
-        The message needs to be:
-            - Sent in a not NSFW channel
-            - From a non-bot user
-            - Have 10 characters or higher
-            - Not start with the bot's command prefix
-            - Sent in a not ignored channel
+        Checks if a message is valid to be put in the bot's database, see MessageFilter
         """
-        if message.channel.is_nsfw():
-            return False
-        if message.author.bot:
-            return False
-        if len(message.content) < 10:
-            return False
-        command_prefixes = {self.settings.get('prefix'), '!', '?', '+', '.'}
-        is_command = (message.content.startswith(prefix) for prefix in command_prefixes)
-        if is_command:
-            return False
-        is_ignored = IgnoredChannel.select().where(IgnoredChannel.channel_id == message.channel.id)
-        if is_ignored:
-            return False
-        return True
+        return self.message_filter.is_valid(message)
 
+    @metrics.ADD_MESSAGE.time()
     def add_message(self, message: discord.Message):
         """
         Adds message details to database if:
@@ -186,98 +338,254 @@ class Bot(commands.Bot):
             - It it wasn't sent in an ignored channel
             - If it doesn't start with the bot's command prefix
             - If it doesn't have less than 10 characters
+
+        Messages are added to the bot's Markov chains right away, but only inserted in the database when the
+        message buffer is flushed
         """
         if self.is_valid_message(message):
-            Message.create(
-                message_id=message.id,
-                content=message.content,
-                author_name=message.author.name,
-                author_id=message.author.id,
-                channel_id=message.channel.id,
-                timestamp=message.created_at
-            )
+            metrics.MESSAGES_ADDED.inc()
+            stored = self.message_buffer.add({
+                "message_id": message.id,
+                "content": message.content,
+                "author_name": message.author.name,
+                "author_id": message.author.id,
+                "channel_id": message.channel.id,
+                "timestamp": message.created_at
+            })
+            if not stored:
+                return
+            self.chains.add(message.channel.id, message.content, message.id)
+            self.add_copy(message.content)
 
     def clean_message(self, content: str, channel_id: int) -> str:
-        # Replaces all mentions to other users or roles in messages with just the names of the user
-        # the mention was referring to
-        # Also wraps @everyone and @here in in-line code so they don't mention anyone
-        # Mentions to users are formatted like so: <@546527580715745290>
-        # Mentions to roles are formatted like so: <@&546527580715745290>
-
-        user_mentions = re.findall(r'(<@\d+>)', content)
-        for mention in user_mentions:
-            user_id = re.search(r'\d+', mention)
-            user_id = user_id.group()
-            user: discord.Member = self.get_user(int(user_id))
-            if user:
-                content = content.replace(mention, user.display_name)
-            else:
-                content = content.replace(mention, '')
-
-        role_mentions = re.findall(r'(<@&\d+>)', content)
-        for mention in role_mentions:
-            role_id = re.search(r'\d+', mention)
-            role_id = role_id.group()
-            channel: discord.TextChannel = self.get_channel(channel_id)
-            guild: discord.Guild = channel.guild
-            role: discord.Role = guild.get_role(int(role_id))
-            if role:
-                content = content.replace(mention, role.name)
-            else:
-                content = content.replace(mention, '')
-
-        content = content.replace('@everyone', '`@everyone`')
-        content = content.replace('@here', '`@here`')
-
-        return content
+        """
+        Replaces all mentions to other users or roles in messages with just the names of the user or role the
+        mention was referring to, also wraps @everyone and @here in in-line code so they don't mention anyone
+
+        See talk_bot.mentions.MentionRewriter
+        """
+        return self.mentions.clean(content, channel_id)
 
+    @metrics.POPULATE_DB.time()
     async def populate_db(self):
-        messages_to_add = []
-        for channel in self.get_all_channels():
-            # Ignore all channels that are not Text Channels (Like Voice Channels)
-            if not type(channel) == discord.TextChannel:
-                continue
-            try:
-                async for message in channel.history(limit=5_000):
-                    if self.is_valid_message(message):
-                        content = self.clean_message(message.content, message.channel.id)
-                        to_add = {
-                            "message_id": message.id,
-                            "content": content,
-                            "author_name": message.author.name,
-                            "author_id": message.author.id,
-                            "channel_id": message.channel.id,
-                            "timestamp": message.created_at
-                        }
-                        messages_to_add.append(to_add)
-            except Exception:
-                pass
-        with db.atomic():
-            for msg in messages_to_add:
-                try:
-                    Message.insert(**msg).on_conflict(
-                        conflict_target=(Message.message_id,),
-                        preserve=(
-                            Message.message_id,
-                            Message.author_id,
-                            Message.author_name,
-                            Message.channel_id,
-                            Message.timestamp
-                        ),
-                        update={Message.content: msg.get('content')}).execute()
-                except Exception as e:
-                    db.rollback()
-                    print(f'{e}: {msg}')
-        print('Finished populating DB.')
+        """
+        Downloads the history of all text channels the bot can read into the database, resuming from where the
+        last run stopped (see talk_bot.tasks.backfill)
+        """
+        start = time.perf_counter()
+        await self.backfill.run()
+        print(f'Finished populating DB in {time.perf_counter() - start:.2f}s.')
+        await self.save_chain()
+
+    @metrics.STORE_HISTORY.time()
+    async def store_history(self, messages_to_add: list):
+        """
+        Stores messages from a channel's history in the database and adds them to the bot's Markov chains
+        """
+        async with self.chains.lock:
+            # Live messages still in the buffer were already added to the chains, they are compared with the history
+            # once stored (and the buffer doesn't overwrite what's stored here once it's flushed)
+            await self.message_buffer.flush()
+            changes = await self.db_executor.run(self.store_messages, messages_to_add)
+            for message_id, channel_id, old_content, new_content in changes:
+                if old_content is not None:
+                    self.chains.remove(channel_id, old_content)
+                self.chains.add(channel_id, new_content, message_id)
+                self.add_copy(new_content)
+        metrics.HISTORY_STORED.inc(len(messages_to_add))
+
+    def store_messages(self, messages_to_add: list) -> list:
+        """
+        Inserts messages in the database, updating the content of the ones that were already stored. Messages are
+        stored as tokens with the 'normalized_storage' setting on (see talk_bot.orm.tokens)
+
+        Returns the id, the channel id, the old content (None if it wasn't stored yet) and the new content of every
+        message whose content changed, so the chains only learn what changed
+        """
+        changes = []
+        stored = {}
+        message_ids = [msg['message_id'] for msg in messages_to_add]
+        for i in range(0, len(message_ids), 500):
+            query = Message.select(Message.message_id, Message.content, Message.tokens).where(
+                Message.message_id.in_(message_ids[i:i + 500])
+            )
+            stored.update(tokens.decode(list(query.tuples()), 1))
+        for msg in storage.upsert(messages_to_add, self.normalized):
+            old_content = stored.get(msg['message_id'])
+            if old_content != msg['content']:
+                changes.append((msg['message_id'], msg['channel_id'], old_content, msg['content']))
+        return changes
 
     @staticmethod
     def db_setup():
         """
-        Setup the bot's database, creates necessary tables if not yet created
+        Setup the bot's database, creates necessary tables if not yet created and migrates the existing ones to the
+        latest schema (see talk_bot.orm.migrations)
         """
-        db.connect()
-        db.create_tables([Message, IgnoredChannel])
-        db.close()
+        applied = migrations.migrate_database()
+        if applied:
+            print(f'Applied {applied} database migrations.')
+
+    def load_outputs(self) -> list:
+        """
+        Reads the channels the bot sends its messages to from the 'outputs' setting, a list of the scope of the
+        chain each channel's messages are made from (see talk_bot.markov.partitions), the id of the channel and
+        the delay (in minutes) between messages
+
+        Without 'outputs', messages are made from all stored messages and sent to 'messages_channel' every
+        'messages_delay' minutes
+
+        Returns a (scope, channel id, delay) tuple for every output
+        """
+        outputs = self.settings.get('outputs') or [{
+            'scope': 'global',
+            'channel': self.settings.get('messages_channel'),
+            'delay': self.settings.get('messages_delay')
+        }]
+        parsed = []
+        for output in outputs:
+            try:
+                scope = parse_scope(output.get('scope', 'global'))
+            except ValueError:
+                print(f'Error: Invalid output scope: {output.get("scope")}')
+                sys.exit(1)
+            try:
+                channel_id = int(output.get('channel'))
+            except (TypeError, ValueError):
+                print(f'Error: Invalid messages channel: {output.get("channel")}')
+                sys.exit(1)
+            try:
+                delay = int(output.get('delay', 5))
+            except (TypeError, ValueError):
+                print(f'Error: Invalid messages delay: {output.get("delay")}')
+                sys.exit(1)
+            parsed.append((scope, channel_id, delay))
+        return parsed
+
+    @staticmethod
+    def load_ignored_channels() -> set:
+        """
+        Loads the ids of all ignored channels, after this they are kept in memory by the bot's MessageFilter
+        """
+        with db.connection_context():
+            return {channel_id for channel_id, in IgnoredChannel.select(IgnoredChannel.channel_id).tuples()}
+
+    async def save_chain(self):
+        """
+        Saves a snapshot of the bot's loaded Markov chains, so they don't need to be rebuilt from the database when
+        they are loaded again
+        """
+        await self.chains.save()
+
+    def add_copy(self, content: str):
+        """
+        Adds the content of a stored message to the filter of phrases that would be a copy of a stored message
+        """
+        # Phrases are the words of the chain joined by spaces
+        self.copies.add(' '.join(tokenize(content)))
+
+    async def load_copies(self):
+        """
+        Adds the content of all stored messages to the filter of phrases that would be a copy of a stored message,
+        see talk_bot.tasks.sender.PhraseBuffer
+        """
+        after_id = 0
+        while True:
+            batch = await self.db_executor.run(corpus.read_batch, Message.content, after=after_id)
+            if not batch:
+                break
+            for message_id, content in batch:
+                self.add_copy(content)
+            after_id = batch[-1][0]
+
+    async def fill_phrases(self):
+        """
+        Keeps the phrase buffers of all scopes full once the bot is ready
+        """
+        await self.wait_until_ready()
+        await asyncio.gather(*(phrases.fill() for phrases in self.phrases.values()))
+
+    def phrases_for(self, channel_id: int):
+        """
+        Returns the phrase buffer of the most specific scope that contains a channel, or None if no scope does
+        """
+        scopes = self.chains.scopes_of(channel_id)
+        scopes.sort(key=lambda scope: ('channel', 'guild', 'global').index(scope.split(':')[0]))
+        return self.phrases[scopes[0]] if scopes else None
+
+    def register_metrics(self):
+        """
+        Adds the metrics read from the bot's state every time they are rendered, see talk_bot.metrics
+        """
+        buffer = self.message_buffer
+        metrics.Gauge('talk_bot_discord_latency_seconds', 'Latency of the heartbeat to Discord', lambda: self.latency)
+        metrics.Gauge('talk_bot_buffered_messages', 'Messages waiting to be inserted in the database', buffer.__len__)
+        metrics.Counter('talk_bot_buffer_flushes_total', 'Flushes of the message buffer', lambda: buffer.flushes)
+        metrics.Counter(
+            'talk_bot_buffer_failed_flushes_total', 'Flushes of the message buffer that failed',
+            lambda: buffer.failed_flushes
+        )
+        metrics.Counter(
+            'talk_bot_buffer_flushed_messages_total', 'Messages inserted by the message buffer',
+            lambda: buffer.flushed_rows
+        )
+        metrics.Counter(
+            'talk_bot_buffer_dropped_messages_total', 'Messages dropped because the message buffer was full',
+            lambda: buffer.dropped_rows
+        )
+        metrics.Gauge(
+            'talk_bot_chain_partitions_loaded', 'Markov chain partitions loaded in memory',
+            lambda: len(self.chains.loaded)
+        )
+        metrics.Gauge(
+            'talk_bot_chain_words', 'Words in the loaded Markov chain partitions',
+            self.chains.words
+        )
+        metrics.Gauge(
+            'talk_bot_buffered_phrases', 'Phrases made up ahead of time',
+            lambda: sum(len(phrases) for phrases in self.phrases.values())
+        )
+        metrics.Gauge('talk_bot_send_queue', 'Messages waiting to be sent to Discord', self.scheduler.__len__)
+        metrics.Gauge('talk_bot_copy_filter_messages', 'Messages in the filter of copied phrases', self.copies.__len__)
+
+    async def serve_metrics(self):
+        """
+        Serves the bot's metrics at http://<metrics_host>:<metrics_port>/metrics, only reachable from this machine
+        unless 'metrics_host' says otherwise
+        """
+        host = self.settings.get('metrics_host', '127.0.0.1')
+        port = int(self.settings.get('metrics_port'))
+        try:
+            self.metrics_runner = await metrics.serve(host, port)
+        except OSError:
+            logging.exception(f'Failed to serve metrics at {host}:{port}')
+
+    async def save_chain_periodically(self):
+        """
+        Saves a snapshot of the bot's Markov chains every 'snapshot_interval' minutes (30 by default)
+        """
+        await self.wait_until_ready()
+        delay = int(self.settings.get('snapshot_interval', 30))
+        while not self.is_closed():
+            await asyncio.sleep(60 * delay)
+            await self.save_chain()
+
+    async def compact_periodically(self):
+        """
+        Archives and deletes the messages expired under the bot's retention policy every 'retention_interval' hours
+        (24 by default), see ChainPartitions.compact
+        """
+        await self.wait_until_ready()
+        delay = float(self.settings.get('retention_interval') or 24)
+        half_life = self.settings.get('retention_half_life')
+        while not self.is_closed():
+            await asyncio.sleep(3600 * delay)
+            try:
+                deleted = await self.chains.compact(self.retention, float(half_life) if half_life else None)
+            except Exception:
+                logging.exception('Failed to compact the database')
+                continue
+            print(f'Archived and deleted {deleted} expired messages.')
 
 
 async def run(settings: dict):
@@ -289,6 +597,14 @@ async def run(settings: dict):
     except discord.errors.LoginFailure:
         print(f"Error: Invalid Token. Please input a valid token in '/talk_bot/settings.json' file.")
         sys.exit(1)
+    finally:
+        bot.scheduler.shutdown()
+        await bot.message_buffer.flush()
+        if bot.metrics_runner is not None:
+            await bot.metrics_runner.cleanup()
+        await bot.save_chain()
+        bot.trainer.shutdown()
+        bot.db_executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import re
+import time
 
 from discord.ext import commands
 
@@ -34,7 +35,8 @@ class ManagementCommands(commands.Cog):
 
         # Only allow a channel to be ignored if the ignore command was sent in the same guild as that channel
         if channel in ctx.guild.channels:
-            ignored, created = IgnoredChannel.get_or_create(channel_id=channel_id)
+            ignored, created = await self.bot.db_executor.run(IgnoredChannel.get_or_create, channel_id=channel_id)
+            self.bot.message_filter.ignore(channel_id)
             if not created:
                 return await ctx.send(f'Channel <#{channel_id}> is already ignored.')
             return await ctx.send(f'Channel <#{channel_id}> ignored successfully.')
@@ -59,19 +61,42 @@ class ManagementCommands(commands.Cog):
             return await ctx.send(f'Invalid Channel: {channel_str}')
 
         channel_id = int(channel_id.group())
-        channel = IgnoredChannel.get(IgnoredChannel.channel_id == channel_id)
-        if not channel:
+        deleted = await self.bot.db_executor.run(
+            IgnoredChannel.delete().where(IgnoredChannel.channel_id == channel_id).execute
+        )
+        self.bot.message_filter.unignore(channel_id)
+        if not deleted:
             return await ctx.send(f'Channel <#{channel_id}> is already not being ignored.')
 
-        IgnoredChannel.delete().where(IgnoredChannel.channel_id == channel_id).execute()
         return await ctx.send(f'Channel <#{channel_id}> is no longer being ignored.')
 
     @commands.is_owner()
     @commands.command()
     async def clean_db(self, ctx: commands.Context):
-        await ctx.send("Cleaning the bot's database...")
-        await self.bot.clean_db()
-        return await ctx.send("Sucessfully cleaned the bot's database.")
+        """
+        Deletes messages in the bot's database that don't meet the criteria to be there anymore
+
+        Progress is reported by editing the status message at most once every 5 seconds
+
+        Requires:
+            - Being the bot's instance Owner
+        """
+        status = await ctx.send("Cleaning the bot's database...")
+        last_report = time.monotonic()
+
+        async def report_progress(checked: int, deleted: int, updated: int):
+            nonlocal last_report
+            if time.monotonic() - last_report < 5:
+                return
+            last_report = time.monotonic()
+            await status.edit(
+                content=f"Cleaning the bot's database... {checked} messages checked, {deleted} deleted, {updated} updated."
+            )
+
+        checked, deleted, updated = await self.bot.clean_db(report_progress)
+        return await ctx.send(
+            f"Sucessfully cleaned the bot's database. {checked} messages checked, {deleted} deleted, {updated} updated."
+        )
 
 
 def setup(bot):
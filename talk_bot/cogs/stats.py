@@ -0,0 +1,71 @@
+import datetime
+
+from discord.ext import commands
+
+from talk_bot import metrics
+
+# Histograms shown by !stats, with the name they are shown as
+TIMINGS = [
+    ('on_message', metrics.ON_MESSAGE),
+    ('add_message', metrics.ADD_MESSAGE),
+    ('buffer_flush', metrics.BUFFER_FLUSH),
+    ('store_history', metrics.STORE_HISTORY),
+    ('populate_db', metrics.POPULATE_DB),
+    ('clean_db', metrics.CLEAN_DB),
+    ('compaction', metrics.COMPACTION),
+    ('db_call', metrics.DB_CALL),
+    ('chain_load', metrics.CHAIN_LOAD),
+    ('make_phrase', metrics.MAKE_PHRASE),
+    ('send', metrics.SEND),
+    ('loop_lag', metrics.LOOP_LAG),
+]
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds == float('inf'):
+        return 'inf'
+    if seconds < 1:
+        return f'{seconds * 1000:.2f}ms'
+    return f'{seconds:.2f}s'
+
+
+class StatsCommands(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx: commands.Context):
+        """
+        Shows the bot's runtime metrics: messages received and stored, what's buffered and loaded in memory, and how
+        long its hot paths take (number of calls, average and the bucket the 95th percentile falls in)
+
+        All metrics are also served in the Prometheus text format if 'metrics_port' is set, see talk_bot.metrics
+
+        Requires:
+            - Being the bot's instance Owner
+        """
+        uptime = datetime.datetime.utcnow() - self.bot.start_time if self.bot.start_time else datetime.timedelta()
+        chains = self.bot.chains.loaded
+        lines = [
+            f'Uptime: {str(uptime).split(".")[0]}',
+            f'Messages: {metrics.MESSAGES_RECEIVED.value} received, {metrics.MESSAGES_ADDED.value} stored, '
+            f'{metrics.HISTORY_STORED.value} from history',
+            f'Buffered: {len(self.bot.message_buffer)} messages, '
+            f'{sum(len(phrases) for phrases in self.bot.phrases.values())} phrases',
+            f'Chains: {len(chains)} partitions loaded, {self.bot.chains.words()} words',
+            f'Phrases: {metrics.PHRASES_REJECTED.value} rejected, {metrics.SEND_FAILURES.value} failed to send',
+            '',
+            f'{"":<14}{"calls":>8}{"average":>10}{"p95 <=":>10}'
+        ]
+        for name, histogram in TIMINGS:
+            if not histogram.count:
+                continue
+            average = format_seconds(histogram.sum / histogram.count)
+            lines.append(f'{name:<14}{histogram.count:>8}{average:>10}{format_seconds(histogram.quantile(0.95)):>10}')
+        return await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+
+def setup(bot):
+    bot.add_cog(StatsCommands(bot))
@@ -0,0 +1,29 @@
+from discord.ext import commands
+
+from talk_bot.tasks.scheduler import SendScheduler
+
+
+class TalkCommands(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.guild_only()
+    @commands.cooldown(1, 5, commands.BucketType.channel)
+    @commands.command()
+    async def talk(self, ctx: commands.Context):
+        """
+        Sends a phrase made up from the messages of this channel (or of its server, or of all servers, depending on
+        the bot's outputs), straight from the bot's buffer of phrases
+        """
+        phrases = self.bot.phrases_for(ctx.channel.id)
+        if phrases is None:
+            return await ctx.send("I don't talk about this channel.")
+        phrase = await phrases.pop()
+        if not phrase:
+            return await ctx.send("I don't know what to say yet.")
+        return await self.bot.scheduler.send(ctx.channel, phrase, priority=SendScheduler.COMMAND)
+
+
+def setup(bot):
+    bot.add_cog(TalkCommands(bot))
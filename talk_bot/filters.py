@@ -0,0 +1,48 @@
+import discord
+
+
+class MessageFilter:
+    """
+    Decides which messages can be stored in the bot's database, without querying the database
+
+    The ignored channels are loaded once when the bot starts and then kept up to date by the ignore and unignore
+    commands through MessageFilter.ignore() and MessageFilter.unignore()
+
+    A message needs to be:
+        - Sent in a not NSFW channel
+        - From a non-bot user
+        - Have 'min_length' characters or more
+        - Not start with the bot's command prefix (or the prefix of other common bots)
+        - Sent in a not ignored channel
+    """
+
+    def __init__(self, prefix: str = None, min_length: int = 10, ignored_channels=()):
+        self.prefixes = tuple({prefix, '!', '?', '+', '.'} - {None, ''})
+        self.min_length = min_length
+        self.ignored_channels = set(ignored_channels)
+
+    def is_valid(self, message: discord.Message) -> bool:
+        if message.channel.is_nsfw():
+            return False
+        if message.author.bot:
+            return False
+        return self.is_valid_content(message.content) and message.channel.id not in self.ignored_channels
+
+    def is_valid_content(self, content: str) -> bool:
+        return len(content) >= self.min_length and not content.startswith(self.prefixes)
+
+    def is_valid_stored(self, channel_id: int, author_id: int, content: str, nsfw_channels: set,
+                        bot_users: set) -> bool:
+        """
+        Checks if a message already stored in the database is still valid, 'nsfw_channels' and 'bot_users' are the
+        ids of the NSFW channels and of the bot users the bot knows about
+        """
+        if channel_id in self.ignored_channels or channel_id in nsfw_channels or author_id in bot_users:
+            return False
+        return self.is_valid_content(content)
+
+    def ignore(self, channel_id: int):
+        self.ignored_channels.add(channel_id)
+
+    def unignore(self, channel_id: int):
+        self.ignored_channels.discard(channel_id)
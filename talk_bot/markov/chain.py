@@ -0,0 +1,346 @@
+import random
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+# Word id marking both the start and the end of a message
+BOUNDARY = 0
+COUNT_MASK = 0xFFFFFFFF
+
+
+def pack_successor(word_id: int, count: int) -> int:
+    """
+    Packs the only successor of a context and its count into a single int
+    """
+    return word_id << 32 | count
+
+
+def unpack_successor(packed: int) -> tuple:
+    return packed >> 32, packed & COUNT_MASK
+
+
+def tokenize(content: str) -> list:
+    """
+    Splits the content of a message into the words used by the chain
+
+    Null characters are dropped, they separate the words of the vocabulary in chain snapshots
+    """
+    return content.replace('\0', '').split(' ')
+
+
+class Vocabulary:
+    """
+    Interns words into integer ids, so the chain's tables only need to store small integers
+
+    Id 0 is reserved for BOUNDARY. Ids are never reused, a word keeps its id even after all messages using it are
+    removed from the chain
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.words = [None]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word_id: int) -> str:
+        return self.words[word_id]
+
+    def intern(self, word: str) -> int:
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+
+class Successors:
+    """
+    Counts of the words that followed a given context, stored as two parallel arrays of word ids and counts
+
+    Sampling uses a cumulative sum of the counts that is built lazily and kept until the counts change,
+    so picking a successor is a binary search over it
+
+    Most contexts only have a handful of successors and are searched linearly, contexts with more than
+    INDEX_THRESHOLD successors also keep a dict from word id to position in the arrays
+    """
+    __slots__ = ('ids', 'counts', 'total', '_cumulative', '_index')
+
+    INDEX_THRESHOLD = 64
+
+    def __init__(self):
+        self.ids = array('I')
+        self.counts = array('I')
+        self.total = 0
+        self._cumulative = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, ids, counts):
+        """
+        Replaces the successors with the ones in buffers of successor ids and counts, like the ones of a snapshot
+        """
+        self.ids = array('I', ids.tobytes())
+        self.counts = array('I', counts.tobytes())
+        self.total = sum(self.counts)
+        self._cumulative = None
+        self._index = None
+        if len(self.ids) > self.INDEX_THRESHOLD:
+            self._index = {successor: position for position, successor in enumerate(self.ids)}
+
+    def _find(self, word_id: int) -> int:
+        if self._index is not None:
+            return self._index.get(word_id, -1)
+        try:
+            return self.ids.index(word_id)
+        except ValueError:
+            return -1
+
+    def add(self, word_id: int, delta: int):
+        i = self._find(word_id)
+        if i < 0:
+            if delta <= 0:
+                return
+            if self._index is not None:
+                self._index[word_id] = len(self.ids)
+            self.ids.append(word_id)
+            self.counts.append(delta)
+            if self._index is None and len(self.ids) > self.INDEX_THRESHOLD:
+                self._index = {successor: position for position, successor in enumerate(self.ids)}
+        else:
+            count = self.counts[i] + delta
+            if count > 0:
+                self.counts[i] = count
+            else:
+                # Removes the successor by moving the last one to its place
+                delta = -self.counts[i]
+                last = self.ids[-1]
+                self.ids[i] = last
+                self.counts[i] = self.counts[-1]
+                del self.ids[-1]
+                del self.counts[-1]
+                if self._index is not None:
+                    self._index[last] = i
+                    del self._index[word_id]
+        self.total += delta
+        self._cumulative = None
+
+    def sample(self) -> int:
+        if self._cumulative is None:
+            self._cumulative = array('Q', accumulate(self.counts))
+        return self.ids[bisect_right(self._cumulative, random.randrange(self.total))]
+
+
+class Node(Successors):
+    """
+    A context of the chain, made of the words that followed it and of the longer contexts that end with it
+
+    The root node is the empty context, its children are the contexts of a single word (the last one), their
+    children the contexts of two words (the last one and the one before it), and so on. 'base' is the index of
+    the node in the chain's snapshot, if it was loaded from one
+    """
+    __slots__ = ('children', 'base')
+
+    def __init__(self, base: int = None):
+        super().__init__()
+        self.children = None
+        self.base = base
+
+
+class MarkovChain:
+    """
+    Markov chain built from the words of the messages stored in the bot's database
+
+    The chain is built once and then kept up to date incrementally, messages are added to it when they
+    are stored in the database and removed from it when they are deleted, so making a phrase never needs
+    to read the database again
+
+    The next word of a phrase is picked from the words that followed its last 'order' words, backing off to
+    shorter contexts when the longer ones were seen less than 'backoff' times. Contexts are stored in a tree of
+    Nodes indexed by their last word, then the word before it and so on, so longer contexts share the memory of
+    the shorter ones and looking up the context of a word is a walk of at most 'order' nodes. Every message starts
+    and ends with BOUNDARY, so phrases start like messages do and stop where messages stop
+
+    Words are interned into integer ids and the successors of every context are stored as arrays of word ids and
+    counts, so memory grows with the number of distinct transitions instead of with the number of words in the
+    corpus. Contexts of 'order' words, which are most of the tree and never have longer contexts, are stored as a
+    single int (see pack_successor) instead of a Node while they only have one successor
+
+    A chain loaded from a snapshot (see talk_bot.markov.snapshot) reads the nodes from the memory-mapped snapshot
+    file the first time they are used, only the nodes that were used or changed since then are held in memory
+    """
+
+    def __init__(self, order: int = 1, backoff: int = 2, snapshot=None):
+        self.order = order
+        self.backoff = backoff
+        self.vocabulary = Vocabulary()
+        self.root = Node(base=0 if snapshot is not None else None)
+        self.snapshot = snapshot
+        # Number of words in the chain
+        self.total = 0
+        # Highest Discord message id added to the chain
+        self.watermark = 0
+
+    def __len__(self):
+        return self.total
+
+    def add(self, content: str, message_id: int = None):
+        """
+        Adds the words of a message to the chain
+        """
+        self.add_ids(self._intern(content), message_id)
+
+    def add_ids(self, word_ids: list, message_id: int = None):
+        """
+        Adds a message whose words were already interned into ids of the chain's vocabulary
+        """
+        self._update([BOUNDARY, *word_ids, BOUNDARY], 1)
+        if message_id and message_id > self.watermark:
+            self.watermark = message_id
+
+    def remove(self, content: str):
+        """
+        Removes the words of a message previously added to the chain
+        """
+        self._update([BOUNDARY, *self._intern(content), BOUNDARY], -1)
+
+    def _intern(self, content: str) -> list:
+        return [self.vocabulary.intern(word) for word in tokenize(content)]
+
+    def _update(self, words: list, delta: int):
+        # 'words' are the ids of the words of a message, between BOUNDARY ids
+        self.total += delta * (len(words) - 2)
+        for i in range(1, len(words)):
+            path = []
+            node = self.root
+            for depth in range(1, min(self.order, i) + 1):
+                if depth == self.order:
+                    self._add_leaf(node, words[i - depth], words[i], delta)
+                    break
+                child = self.child(node, words[i - depth], create=delta > 0)
+                if child is None:
+                    break
+                child.add(words[i], delta)
+                path.append((node, words[i - depth], child))
+                node = child
+            if delta < 0:
+                self._prune(path)
+
+    def _add_leaf(self, node: Node, word_id: int, successor: int, delta: int):
+        leaf = self.leaf(node, word_id)
+        if isinstance(leaf, Node):
+            leaf.add(successor, delta)
+            if leaf.total:
+                return
+            count = 0
+        else:
+            leaf_successor, count = unpack_successor(leaf) if leaf is not None else (successor, 0)
+            if leaf_successor == successor or not count:
+                count = max(count + delta, 0)
+                leaf = pack_successor(successor, count)
+            elif delta > 0:
+                leaf = Node()
+                leaf.add(leaf_successor, count)
+                leaf.add(successor, delta)
+            else:
+                return
+        if count or node.base is not None:
+            # Contexts from the snapshot that are not seen anymore are kept with a count of 0, or they would be
+            # read from it again
+            if node.children is None:
+                node.children = {}
+            node.children[word_id] = leaf
+        elif node.children is not None:
+            node.children.pop(word_id, None)
+            if not node.children:
+                node.children = None
+
+    @staticmethod
+    def _prune(path: list):
+        # A context that is not seen anymore has no longer contexts either. Nodes from the snapshot are kept, or
+        # they would be read from it again
+        for parent, word_id, node in reversed(path):
+            if node.total or node.base is not None:
+                break
+            del parent.children[word_id]
+            if not parent.children:
+                parent.children = None
+
+    def child(self, node: Node, word_id: int, create: bool = False):
+        """
+        Returns the child of a node for the context made longer by 'word_id', or None if that context was never seen
+
+        The node must be a context of less than 'order' - 1 words, the children of the ones with 'order' - 1 words
+        are looked up with leaf
+        """
+        if node.children is not None:
+            child = node.children.get(word_id)
+            if child is not None:
+                return child
+        if node.base is not None:
+            child = self.snapshot.child(node.base, word_id)
+        else:
+            child = None
+        if child is None and create:
+            child = Node()
+        if child is not None:
+            if node.children is None:
+                node.children = {}
+            node.children[word_id] = child
+        return child
+
+    def leaf(self, node: Node, word_id: int):
+        """
+        Returns the context of 'order' words made by adding 'word_id' to a node, either as a Node or as a packed
+        successor if it only has one, or None if that context was never seen
+        """
+        if node.children is not None:
+            leaf = node.children.get(word_id)
+            if leaf is not None:
+                return leaf
+        if node.base is None:
+            return None
+        leaf = self.snapshot.leaf(node.base, word_id)
+        if leaf is not None:
+            if node.children is None:
+                node.children = {}
+            node.children[word_id] = leaf
+        return leaf
+
+    def context(self, words: list):
+        """
+        Returns the successors of the longest context at the end of 'words' that was seen at least 'backoff' times,
+        or None if the last word was never followed by anything
+        """
+        context = None
+        node = self.root
+        for depth in range(1, min(self.order, len(words)) + 1):
+            if depth == self.order:
+                child = self.leaf(node, words[-depth])
+                if child is not None and not isinstance(child, Node):
+                    packed, child = child, Successors()
+                    child.add(*unpack_successor(packed))
+            else:
+                child = self.child(node, words[-depth])
+            if child is None or child.total < (self.backoff if context is not None else 1):
+                break
+            context = node = child
+        return context
+
+    def make_phrase(self, size: int = 30) -> str:
+        """
+        Makes up a new phrase of at most 'size' words by walking the chain from the start of a message until the
+        end of one
+        """
+        phrase = [BOUNDARY]
+        for i in range(size):
+            node = self.context(phrase)
+            if node is None:
+                break
+            word_id = node.sample()
+            if word_id == BOUNDARY:
+                break
+            phrase.append(word_id)
+        return ' '.join(self.vocabulary[word_id] for word_id in phrase[1:])
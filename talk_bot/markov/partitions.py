@@ -0,0 +1,329 @@
+"""
+Partitions of the bot's Markov chain, so every guild or channel the bot talks in can speak with its own voice
+
+A partition is identified by its scope:
+
+    - 'global': every message stored by the bot
+    - 'guild:<guild id>': the messages of all channels of a guild
+    - 'channel:<channel id>': the messages of a single channel
+
+A message belongs to every configured scope that contains it, so the same message can teach both the chain of its
+channel and the one of its guild
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from talk_bot import metrics
+from talk_bot.markov import snapshot
+from talk_bot.markov.chain import MarkovChain
+from talk_bot.markov.training import Trainer, compact, finish_compaction
+from talk_bot.orm import corpus
+from talk_bot.orm.retention import RetentionPolicy
+from talk_bot.orm.models import Message
+
+
+def parse_scope(scope: str) -> str:
+    """
+    Returns a scope in its normal form
+
+    Raises ValueError if 'scope' is not 'global', 'guild:<guild id>' or 'channel:<channel id>'
+    """
+    kind, _, scope_id = str(scope).strip().partition(':')
+    if kind == 'global' and not scope_id:
+        return kind
+    if kind in ('guild', 'channel') and scope_id.strip().isdigit():
+        return f'{kind}:{int(scope_id)}'
+    raise ValueError(f'Invalid scope: {scope}')
+
+
+class ChainPartitions:
+    """
+    Markov chains of all configured scopes, see parse_scope
+
+    Partitions are loaded the first time they are used, from their snapshot in 'snapshot_dir' and the messages
+    stored after that snapshot was saved. Loaded partitions are kept in memory while they hold at most
+    'word_budget' words between all of them, past that the least recently used ones are saved and evicted
+
+    Partitions missing more than TRAIN_THRESHOLD stored messages are brought up to date by 'trainer' (see
+    talk_bot.markov.training) before they are loaded, so the event loop never builds a large chain. A training
+    that fails or takes more than 'train_timeout' seconds is stopped, and the partition is loaded without it
+
+    Partitions that are not loaded ignore new messages, they are read from the database when the partition is
+    loaded. A change to a message their snapshot already has deletes the snapshot instead, so the partition is
+    rebuilt from the database the next time it's loaded
+    """
+
+    TRAIN_THRESHOLD = 10_000
+
+    def __init__(self, bot, scopes: list, order: int = 1, backoff: int = 2, snapshot_dir: str = 'snapshots',
+                 word_budget: int = 2_000_000, trainer: Trainer = None, train_timeout: float = 1800):
+        self.bot = bot
+        self.scopes = set(scopes)
+        self.order = order
+        self.backoff = backoff
+        self.snapshot_dir = snapshot_dir
+        self.word_budget = word_budget
+        self.trainer = trainer
+        self.train_timeout = train_timeout
+        self.loaded = OrderedDict()
+        self.dirty = set()
+        # Changes held back for the partitions whose snapshot is being written, by scope
+        self.saving = {}
+        # Hold it while writing messages to the database and applying the changes to the chains, so a partition
+        # never loads a message from the database and is then told about it again
+        self.lock = asyncio.Lock()
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.journal = os.path.join(snapshot_dir, 'compaction.journal')
+        self.watermarks = {}
+        self.read_watermarks()
+
+    def read_watermarks(self):
+        """
+        Reads the watermark of the snapshot of every partition, 0 for the ones without a valid snapshot
+        """
+        for scope in self.scopes:
+            try:
+                self.watermarks[scope] = snapshot.read_watermark(self.path(scope))
+            except (FileNotFoundError, snapshot.SnapshotError):
+                self.watermarks[scope] = 0
+
+    def path(self, scope: str) -> str:
+        return os.path.join(self.snapshot_dir, f'{scope.replace(":", "-")}.snapshot')
+
+    def scopes_of(self, channel_id: int) -> list:
+        """
+        Returns the configured scopes that contain the messages of a channel
+        """
+        scopes = ['global']
+        if channel_id is not None:
+            scopes.append(f'channel:{channel_id}')
+            channel = self.bot.get_channel(channel_id)
+            guild = getattr(channel, 'guild', None)
+            if guild is not None:
+                scopes.append(f'guild:{guild.id}')
+        return [scope for scope in scopes if scope in self.scopes]
+
+    def add(self, channel_id: int, content: str, message_id: int = None):
+        """
+        Adds the words of a message sent in a channel to the partitions it belongs to
+        """
+        for scope in self.scopes_of(channel_id):
+            self.apply(scope, False, content, message_id)
+
+    def remove(self, channel_id: int, content: str):
+        """
+        Removes the words of a message sent in a channel from the partitions it belongs to
+        """
+        for scope in self.scopes_of(channel_id):
+            self.apply(scope, True, content)
+
+    def apply(self, scope: str, remove: bool, content: str, message_id: int = None):
+        """
+        Adds or removes the words of a message to or from a partition, or holds the change back until its snapshot
+        is written if it's being saved (see save_partition)
+        """
+        if scope in self.saving:
+            self.saving[scope].append((remove, content, message_id))
+            return
+        chain = self.loaded.get(scope)
+        if chain is not None:
+            if remove:
+                chain.remove(content)
+            else:
+                chain.add(content, message_id)
+            self.dirty.add(scope)
+        elif remove or message_id is None or message_id <= self.watermarks[scope]:
+            self.invalidate(scope)
+
+    def invalidate(self, scope: str):
+        if self.watermarks[scope]:
+            try:
+                os.remove(self.path(scope))
+            except FileNotFoundError:
+                pass
+            self.watermarks[scope] = 0
+
+    async def get(self, scope: str) -> MarkovChain:
+        """
+        Returns the chain of a scope, loading it if needed
+        """
+        if scope not in self.loaded:
+            async with self.lock:
+                if scope not in self.loaded:
+                    start = time.perf_counter()
+                    # Its archive may hold messages that are still stored otherwise
+                    await self.finish_compaction()
+                    await self.train(scope)
+                    # Buffered messages are not in the database yet, nothing is flushed while the partition loads
+                    async with self.bot.message_buffer.lock:
+                        self.loaded[scope] = await self.load(scope)
+                    metrics.CHAIN_LOAD.observe(time.perf_counter() - start)
+        self.loaded.move_to_end(scope)
+        chain = self.loaded[scope]
+        if self.words() > self.word_budget:
+            async with self.lock:
+                await self.evict()
+        return chain
+
+    def channel_ids(self, scope: str):
+        """
+        Returns the ids of the channels whose messages belong to a scope, or None for all channels
+        """
+        if scope.startswith('channel:'):
+            return [int(scope.split(':')[1])]
+        if scope.startswith('guild:'):
+            guild = self.bot.get_guild(int(scope.split(':')[1]))
+            return [channel.id for channel in guild.channels] if guild is not None else []
+        return None
+
+    async def train(self, scope: str):
+        if self.trainer is None:
+            return
+        channel_ids = self.channel_ids(scope)
+        missing = await self.bot.db_executor.run(
+            lambda: corpus.select(after=self.watermarks[scope], channel_ids=channel_ids).count()
+        )
+        if missing > self.TRAIN_THRESHOLD:
+            try:
+                words, watermark = await asyncio.wait_for(
+                    self.trainer.train(self.path(scope), self.order, self.backoff, channel_ids), self.train_timeout
+                )
+            except Exception:
+                # The partition is loaded (more slowly) without the worker
+                logging.exception(f'Failed to train the Markov chain of {scope}')
+                return
+            self.watermarks[scope] = watermark
+            print(f'Trained Markov chain of {scope} with {missing} messages, {words} words.')
+
+    async def load(self, scope: str) -> MarkovChain:
+        """
+        Loads the chain of a scope from its snapshot and adds to it the messages stored in the database (or waiting
+        in the message buffer) after that snapshot was saved
+        """
+        loop = asyncio.get_event_loop()
+        # Reading the vocabulary of a large snapshot takes a while, the event loop keeps running meanwhile
+        chain = await loop.run_in_executor(
+            None, snapshot.load_or_archive, self.path(scope), self.order, self.backoff
+        )
+        watermark = chain.watermark
+        channel_ids = self.channel_ids(scope)
+
+        # Read in batches, so only one batch is in memory at a time
+        after_id = watermark
+        while True:
+            batch = await self.bot.db_executor.run(
+                corpus.read_batch, Message.content, after=after_id, channel_ids=channel_ids
+            )
+            for message_id, content in batch:
+                chain.add(content, message_id)
+            if not batch:
+                break
+            after_id = batch[-1][0]
+        for row in self.bot.message_buffer.rows:
+            if row['message_id'] > watermark and (channel_ids is None or row['channel_id'] in channel_ids):
+                chain.add(row['content'], row['message_id'])
+        if chain.watermark != watermark or not watermark:
+            self.dirty.add(scope)
+        return chain
+
+    async def compact(self, policy: RetentionPolicy, half_life: float = None) -> int:
+        """
+        Folds the messages expired under a retention policy into the archives of all partitions and deletes them,
+        see talk_bot.markov.training.compact. Partitions are neither loaded nor changed while it runs
+
+        With a 'half_life' the snapshots of partitions whose archive decayed are rebuilt, loaded partitions are
+        saved and evicted first so they are loaded again from the rebuilt snapshots
+
+        Returns the number of messages deleted
+        """
+        async with self.lock:
+            start = time.perf_counter()
+            if half_life:
+                for scope, chain in list(self.loaded.items()):
+                    await self.save_partition(scope, chain)
+                self.loaded.clear()
+            scopes = {scope: (self.path(scope), self.channel_ids(scope)) for scope in self.scopes}
+            try:
+                if self.trainer is not None:
+                    deleted, watermarks = await asyncio.wait_for(
+                        self.trainer.compact(scopes, self.journal, self.order, self.backoff, policy, half_life),
+                        self.train_timeout
+                    )
+                else:
+                    deleted, watermarks = await asyncio.get_event_loop().run_in_executor(
+                        None, compact, scopes, self.journal, self.order, self.backoff, policy, half_life
+                    )
+            except BaseException:
+                # Also when cancelled: the worker may have stopped after its journal was written, or while
+                # rebuilding a snapshot it had already deleted
+                await self.finish_compaction()
+                self.read_watermarks()
+                raise
+            self.watermarks.update(watermarks)
+            metrics.COMPACTION.observe(time.perf_counter() - start)
+        metrics.MESSAGES_COMPACTED.inc(deleted)
+        return deleted
+
+    async def finish_compaction(self):
+        """
+        Finishes a compaction that was stopped halfway, see talk_bot.markov.training.compact. Must be called
+        holding the lock
+        """
+        if os.path.exists(self.journal):
+            await self.bot.db_executor.run(finish_compaction, self.journal)
+
+    def words(self) -> int:
+        """
+        Number of words in all loaded partitions
+        """
+        return sum(len(chain) for chain in self.loaded.values())
+
+    async def evict(self):
+        """
+        Saves and evicts the least recently used partitions until the loaded ones fit in the word budget, the most
+        recently used partition is always kept. Must be called holding the lock, see save_partition
+
+        An evicted partition is not loaded anymore while its snapshot is written, so the changes held back
+        meanwhile are applied like to any partition that is not loaded
+        """
+        while len(self.loaded) > 1 and self.words() > self.word_budget:
+            scope, chain = self.loaded.popitem(last=False)
+            await self.save_partition(scope, chain)
+
+    async def save_partition(self, scope: str, chain: MarkovChain):
+        """
+        Saves a snapshot of a partition if it changed since it was last saved. Must be called holding the lock, so
+        the partition is not loaded again while its snapshot is written
+
+        Walking a large chain takes seconds, so the snapshot is written by a thread of the default executor and
+        only moved into place by the event loop. Changes to the partition meanwhile are held back and applied once
+        it's written
+        """
+        if scope not in self.dirty:
+            self.watermarks[scope] = chain.watermark
+            return
+        self.dirty.discard(scope)
+        self.saving[scope] = []
+        try:
+            path = self.path(scope)
+            temporary_path = await asyncio.get_event_loop().run_in_executor(None, snapshot.write, chain, path)
+            os.replace(temporary_path, path)
+            self.watermarks[scope] = chain.watermark
+        except Exception:
+            self.dirty.add(scope)
+            raise
+        finally:
+            for change in self.saving.pop(scope):
+                self.apply(scope, *change)
+
+    async def save(self):
+        """
+        Saves a snapshot of every loaded partition that changed since it was last saved
+        """
+        async with self.lock:
+            for scope, chain in list(self.loaded.items()):
+                await self.save_partition(scope, chain)
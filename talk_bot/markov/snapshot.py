@@ -0,0 +1,288 @@
+"""
+Binary snapshots of the bot's Markov chain
+
+A snapshot file is laid out as follows, all numbers in little-endian and every section starting at a
+multiple of 8 bytes:
+
+    - Header (see HEADER): magic bytes, format version, order of the chain, watermark (highest Discord message
+      id in the chain), number of words in the chain, size of the vocabulary, number of nodes, number of
+      transitions and size of the vocabulary section
+    - Vocabulary: all words of the chain but BOUNDARY encoded in UTF-8 and separated by null characters, the
+      position of a word (starting at 1) is its id
+    - Node words: uint32 id of the word that each node adds to the context of its parent. Nodes are stored in
+      breadth-first order starting with the root, with the children of each node sorted by word id
+    - Children offsets: uint32 index of the first child of each node, with one extra offset marking the end of
+      the children of the last node, the children of a node are all the nodes up to the first child of the next
+    - Successor offsets: uint64 position in the transitions sections where the successors of each node start,
+      with one extra offset marking the end of the successors of the last node
+    - Successor ids: uint32 word ids of the successors of all nodes
+    - Successor counts: uint32 counts of the successors of all nodes
+
+Loading a snapshot memory-maps the file and only reads the vocabulary, every node is copied out of the file the
+first time the chain needs it
+"""
+import os
+import sys
+import mmap
+import random
+import struct
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+from talk_bot.markov.chain import COUNT_MASK, MarkovChain, Node, pack_successor
+
+MAGIC = b'TBMC'
+VERSION = 2
+HEADER = struct.Struct('<4sHHqQIIQQ')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _padding(size: int) -> bytes:
+    return b'\0' * (-size % 8)
+
+
+def _padded(size: int) -> int:
+    return size + -size % 8
+
+
+class SnapshotNodes:
+    """
+    Read-only view of the nodes stored in a memory-mapped snapshot file
+    """
+
+    def __init__(self, view: memoryview, nodes: int, transitions: int, offset: int):
+        self.words = view[offset:offset + nodes * 4].cast('I')
+        offset += _padded(nodes * 4)
+        self.children = view[offset:offset + (nodes + 1) * 4].cast('I')
+        offset += _padded((nodes + 1) * 4)
+        self.offsets = view[offset:offset + (nodes + 1) * 8].cast('Q')
+        offset += (nodes + 1) * 8
+        self.ids = view[offset:offset + transitions * 4].cast('I')
+        offset += _padded(transitions * 4)
+        self.counts = view[offset:offset + transitions * 4].cast('I')
+
+    def child_indexes(self, index: int) -> range:
+        return range(self.children[index], self.children[index + 1])
+
+    def successors(self, index: int) -> tuple:
+        """
+        Returns the successor ids and counts of a node as memoryviews of the snapshot file
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.ids[start:end], self.counts[start:end]
+
+    def find(self, index: int, word_id: int) -> int:
+        """
+        Returns the index of the child of a node for the context made longer by 'word_id', or -1 if there's none
+        """
+        start, end = self.children[index], self.children[index + 1]
+        i = bisect_left(self.words, word_id, start, end)
+        if i == end or self.words[i] != word_id:
+            return -1
+        return i
+
+    def child(self, index: int, word_id: int):
+        """
+        Returns a copy of the child of a node for the context made longer by 'word_id', or None if there's none
+        """
+        i = self.find(index, word_id)
+        if i < 0:
+            return None
+        node = Node(base=i)
+        node.load(*self.successors(i))
+        return node
+
+    def leaf(self, index: int, word_id: int):
+        """
+        Like child, but for contexts of the chain's order, which are returned packed if they only have one successor
+        """
+        i = self.find(index, word_id)
+        if i < 0:
+            return None
+        ids, counts = self.successors(i)
+        if len(ids) == 1:
+            return pack_successor(ids[0], counts[0])
+        node = Node(base=i)
+        node.load(ids, counts)
+        return node
+
+
+def _decay(ids, counts, factor: float) -> tuple:
+    """
+    Scales counts by 'factor', rounding them up with the probability of their fraction so the expected count stays
+    the same, and leaves out the successors whose count drops to 0
+    """
+    decayed_ids = array('I')
+    decayed_counts = array('I')
+    for successor, count in zip(ids, counts):
+        scaled = count * factor
+        count = int(scaled) + (random.random() < scaled % 1)
+        if count:
+            decayed_ids.append(successor)
+            decayed_counts.append(count)
+    return decayed_ids, decayed_counts
+
+
+def save(chain: MarkovChain, path: str, decay: float = 1):
+    """
+    Saves a chain to a snapshot file, the snapshot is written to a temporary file first and then moved
+    over 'path' so a crash never leaves a half-written snapshot behind
+
+    With a 'decay' lower than 1 every count is saved multiplied by it (see _decay), so what the chain learned
+    weighs less against what it learns after. The chain in memory is left as it was
+    """
+    os.replace(write(chain, path, decay), path)
+
+
+def write(chain: MarkovChain, path: str, decay: float = 1) -> str:
+    """
+    Writes a snapshot of a chain to a temporary file next to 'path' and returns the path of that file, for the
+    caller to move over 'path' (see save)
+
+    Walking the whole chain takes a while for large ones, so it can run in another thread while the event loop
+    keeps making phrases from the chain, as long as nothing is added to or removed from the chain meanwhile.
+    Making a phrase only copies nodes out of the chain's snapshot, that hold the same successors either way
+    """
+    words = array('I')
+    children = array('I')
+    offsets = array('Q', [0])
+    successor_ids = array('I')
+    successor_counts = array('I')
+
+    # Nodes are (word id, node or packed successor in memory or None, index in the current snapshot or None)
+    queue = deque([(0, chain.root, chain.root.base)])
+    while queue:
+        word_id, node, base = queue.popleft()
+        words.append(word_id)
+        children.append(len(words) + len(queue))
+        if isinstance(node, Node):
+            ids, counts = node.ids, node.counts
+        elif node is not None:
+            ids, counts = array('I', [node >> 32]), array('I', [node & COUNT_MASK])
+        else:
+            ids, counts = chain.snapshot.successors(base)
+        if decay < 1:
+            ids, counts = _decay(ids, counts, decay)
+        successor_ids.frombytes(ids.tobytes())
+        successor_counts.frombytes(counts.tobytes())
+        offsets.append(len(successor_ids))
+
+        node_children = {}
+        if base is not None:
+            for i in chain.snapshot.child_indexes(base):
+                node_children[chain.snapshot.words[i]] = (None, i)
+        if isinstance(node, Node) and node.children is not None:
+            # Copied at once, making a phrase in another thread may add nodes to the dict meanwhile
+            for child_word_id, child in list(node.children.items()):
+                # Contexts that are not seen anymore have no longer contexts either
+                if isinstance(child, Node) and child.total:
+                    node_children[child_word_id] = (child, child.base)
+                elif not isinstance(child, Node) and child & COUNT_MASK:
+                    node_children[child_word_id] = (child, None)
+                else:
+                    node_children.pop(child_word_id, None)
+        for child_word_id in sorted(node_children):
+            queue.append((child_word_id, *node_children[child_word_id]))
+    children.append(len(words))
+
+    vocabulary = '\0'.join(chain.vocabulary.words[1:]).encode('utf-8')
+    sections = [vocabulary, words, children, offsets, successor_ids, successor_counts]
+    if sys.byteorder != 'little':
+        for section in sections[1:]:
+            section.byteswap()
+
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, VERSION, chain.order, chain.watermark, round(chain.total * decay), len(chain.vocabulary), len(words),
+            len(successor_ids), len(vocabulary)
+        ))
+        for section in sections:
+            data = section if isinstance(section, bytes) else section.tobytes()
+            f.write(data)
+            f.write(_padding(len(data)))
+    return temporary_path
+
+
+def read_watermark(path: str) -> int:
+    """
+    Reads the watermark of a snapshot from its header, without loading it
+
+    Raises FileNotFoundError if there is no snapshot at 'path' and SnapshotError if the file is not a snapshot
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise SnapshotError(f'Truncated snapshot file: {path}')
+    magic, version, _, watermark, *_ = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError(f'Not a chain snapshot of version {VERSION}: {path}')
+    return watermark
+
+
+def load(path: str, order: int = 1, backoff: int = 2) -> MarkovChain:
+    """
+    Loads a chain from a snapshot file
+
+    Raises FileNotFoundError if there is no snapshot at 'path' and SnapshotError if the file is not a
+    snapshot of a chain of the given order that can be loaded
+    """
+    if sys.byteorder != 'little':
+        raise SnapshotError('Memory-mapped snapshots are only supported on little-endian machines')
+    with open(path, 'rb') as f:
+        try:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            raise SnapshotError(f'Empty snapshot file: {path}')
+    if len(view) < HEADER.size:
+        raise SnapshotError(f'Truncated snapshot file: {path}')
+    magic, version, snapshot_order, watermark, total, words, nodes, transitions, vocabulary_size = \
+        HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise SnapshotError(f'Not a chain snapshot: {path}')
+    if version != VERSION:
+        raise SnapshotError(f'Unsupported snapshot version {version} (expected {VERSION}): {path}')
+    if snapshot_order != order:
+        raise SnapshotError(f'Snapshot is of a chain of order {snapshot_order} (expected {order}): {path}')
+    expected_size = (
+        HEADER.size + _padded(vocabulary_size) + _padded(nodes * 4) + _padded((nodes + 1) * 4) + (nodes + 1) * 8
+        + _padded(transitions * 4) * 2
+    )
+    if len(view) != expected_size:
+        raise SnapshotError(f'Snapshot file has {len(view)} bytes, expected {expected_size}: {path}')
+
+    offset = HEADER.size
+    snapshot = SnapshotNodes(view, nodes, transitions, offset + _padded(vocabulary_size))
+    chain = MarkovChain(order, backoff, snapshot=snapshot)
+    if words > 1:
+        chain.vocabulary.words += bytes(view[offset:offset + vocabulary_size]).decode('utf-8').split('\0')
+        chain.vocabulary.ids = {word: word_id for word_id, word in enumerate(chain.vocabulary.words) if word_id}
+    chain.total = total
+    chain.watermark = watermark
+    return chain
+
+
+def archive_path(path: str) -> str:
+    """
+    Path of the archive of the chain saved at 'path': a snapshot of what the chain learned from messages that were
+    deleted from the database (see talk_bot.markov.training.compact), that the chain is rebuilt from
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}.archive{extension}'
+
+
+def load_or_archive(path: str, order: int = 1, backoff: int = 2) -> MarkovChain:
+    """
+    Loads the chain saved at 'path', or its archive if there's no valid snapshot there (so the messages still
+    stored can be added to it), or returns an empty chain if there's neither
+    """
+    for candidate in (path, archive_path(path)):
+        try:
+            return load(candidate, order, backoff)
+        except (FileNotFoundError, SnapshotError):
+            pass
+    return MarkovChain(order, backoff)
@@ -0,0 +1,248 @@
+"""
+Training of Markov chains in worker processes
+
+Building a chain from a large number of messages is pure Python work that would block the bot's event loop (and
+with it the connection to Discord) for as long as it takes. Workers read the messages from the database on their
+own, add them to the chain's snapshot and save it, the bot then only needs to memory-map the new snapshot
+"""
+import os
+import json
+import time
+import asyncio
+import multiprocessing
+from array import array
+
+from talk_bot.markov import snapshot
+from talk_bot.markov.chain import MarkovChain
+from talk_bot.orm import corpus, tokens, retention
+from talk_bot.orm.models import db
+
+
+def train(path: str, order: int, backoff: int, channel_ids: list = None) -> tuple:
+    """
+    Adds the messages stored after the snapshot at 'path' was saved to it (all messages on top of the chain's
+    archive, if there's no valid snapshot there yet) and saves it again, only messages from the given channels
+    unless 'channel_ids' is None
+
+    Messages stored as tokens (see talk_bot.orm.tokens) are added without joining and splitting their words again,
+    every token id is translated into a word id of the chain once
+
+    Returns the number of words in the chain and its watermark
+    """
+    chain = snapshot.load_or_archive(path, order, backoff)
+    word_ids = {}
+
+    def translate(token_id: int) -> int:
+        word_id = word_ids[token_id] = chain.vocabulary.intern(tokens.words[token_id])
+        return word_id
+
+    with db.connection_context():
+        for message_id, content, token_ids in corpus.read_tokens(chain.watermark, channel_ids):
+            if token_ids is None:
+                chain.add(content, message_id)
+            else:
+                # Word ids are never 0 (BOUNDARY)
+                chain.add_ids([word_ids.get(token_id) or translate(token_id) for token_id in token_ids], message_id)
+    snapshot.save(chain, path)
+    return len(chain), chain.watermark
+
+
+def compact(scopes: dict, journal: str, order: int, backoff: int, policy: retention.RetentionPolicy,
+            half_life: float = None) -> tuple:
+    """
+    Folds the messages expired under 'policy' into the archives of the chains of 'scopes' (a dict of the path of
+    every chain's snapshot and the channels it learns from, None for all of them) and deletes them from the
+    database. A chain's snapshot already holds the expired messages up to its watermark, the ones stored after it
+    was saved (while its partition wasn't loaded, see ChainPartitions.apply) are added to it as well, without
+    moving its watermark so the messages left are still added when it's loaded
+
+    With a 'half_life' (in days) what an archive learned before is weighed down by half for every 'half_life'
+    days since it was last saved, so the chains slowly forget old messages instead of keeping them forever. The
+    snapshots of the chains whose archive decayed are then rebuilt from it and the messages left
+
+    The new archives and snapshots are written next to the old ones, then the ids of the expired messages and
+    where the files go are written to 'journal', and only then are the files moved into place and the messages
+    deleted. A compaction stopped before its journal is written changed nothing, one stopped after it is finished
+    by finish_compaction (here, the next time, or by the bot before it loads a chain), so no message is ever
+    archived twice
+
+    Returns the number of messages deleted and the watermark of every rebuilt snapshot
+    """
+    with db.connection_context():
+        finish_compaction(journal)
+        expired = retention.expired_ids(policy)
+        if not expired:
+            return 0, {}
+        archives = {}
+        # None for the chains without a valid snapshot, they are rebuilt from their archive
+        snapshot_watermarks = {}
+        for scope, (path, channel_ids) in scopes.items():
+            try:
+                archives[scope] = snapshot.load(snapshot.archive_path(path), order, backoff)
+            except (FileNotFoundError, snapshot.SnapshotError):
+                archives[scope] = MarkovChain(order, backoff)
+            try:
+                snapshot_watermarks[scope] = snapshot.read_watermark(path)
+            except (FileNotFoundError, snapshot.SnapshotError):
+                snapshot_watermarks[scope] = None
+        touched = set()
+        # Snapshots missing some of the expired messages
+        stale = {}
+        for messages in retention.read_messages(expired):
+            for message_id, channel_id, content in messages:
+                for scope, (path, channel_ids) in scopes.items():
+                    if channel_ids is None or channel_id in channel_ids:
+                        archives[scope].add(content)
+                        touched.add(scope)
+                        if snapshot_watermarks[scope] is not None and message_id > snapshot_watermarks[scope]:
+                            if scope not in stale:
+                                try:
+                                    stale[scope] = snapshot.load(path, order, backoff)
+                                except snapshot.SnapshotError:
+                                    snapshot_watermarks[scope] = None
+                                    continue
+                            stale[scope].add(content)
+
+        decayed = set()
+        # Temporary path and final path of every file written
+        written = []
+        for scope in touched:
+            path = snapshot.archive_path(scopes[scope][0])
+            decay = 1
+            if half_life and os.path.exists(path):
+                days = (time.time() - os.path.getmtime(path)) / 86400
+                decay = 0.5 ** (days / half_life)
+                decayed.add(scope)
+            written.append((snapshot.write(archives[scope], path, decay), path))
+        for scope, chain in stale.items():
+            # Rebuilt from the decayed archive below anyway
+            if scope not in decayed:
+                path = scopes[scope][0]
+                # Not at the temporary path of the snapshot, where the bot writes it when it's saved
+                written.append((snapshot.write(chain, f'{path}.compacted'), path))
+        with open(f'{journal}.tmp', 'w') as f:
+            json.dump({'ids': list(expired), 'files': written}, f)
+        os.replace(f'{journal}.tmp', journal)
+        finish_compaction(journal)
+
+    watermarks = {}
+    for scope in decayed:
+        path, channel_ids = scopes[scope]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _, watermarks[scope] = train(path, order, backoff, channel_ids)
+    return len(expired), watermarks
+
+
+def finish_compaction(journal: str):
+    """
+    Finishes the compaction whose journal is at 'journal', if there's one: moves the files it wrote that are still
+    next to their final path into place, deletes the messages it archived and then the journal. Must run with a
+    database connection
+    """
+    try:
+        with open(journal) as f:
+            pending = json.load(f)
+    except FileNotFoundError:
+        return
+    for temporary_path, path in pending['files']:
+        if os.path.exists(temporary_path):
+            os.replace(temporary_path, path)
+    retention.delete(array('q', pending['ids']))
+    os.remove(journal)
+
+
+class WorkerError(Exception):
+    pass
+
+
+def work(connection, function, args: tuple):
+    """
+    Runs in a worker process, sends the result of calling 'function' (or the exception it raised) through
+    'connection'
+    """
+    try:
+        result = (True, function(*args))
+    except Exception as e:
+        result = (False, e)
+    try:
+        connection.send(result)
+    except Exception as e:
+        # The result or the exception couldn't be pickled
+        connection.send((False, WorkerError(repr(e))))
+    connection.close()
+
+
+class Trainer:
+    """
+    Runs train and compact in worker processes, at most 'workers' at a time
+
+    Every task runs in a new process, so the memory used to build a chain is given back to the system as soon
+    as its snapshot is saved. Processes are spawned instead of forked, a forked process would share the bot's
+    database connections
+
+    The result of a task is read from a pipe, that is closed as soon as its process exits: a task whose process
+    dies without sending it (killed by the system for running out of memory, for example) raises WorkerError
+    instead of never returning. The process of a task that is cancelled (like by asyncio.wait_for) is terminated,
+    and the task only ends once it has exited
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.semaphore = None
+        self.processes = set()
+
+    async def train(self, path: str, order: int, backoff: int, channel_ids: list = None) -> tuple:
+        return await self.run(train, path, order, backoff, channel_ids)
+
+    async def compact(self, scopes: dict, journal: str, order: int, backoff: int, policy: retention.RetentionPolicy,
+                      half_life: float = None) -> tuple:
+        return await self.run(compact, scopes, journal, order, backoff, policy, half_life)
+
+    async def run(self, function, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        async with self.semaphore:
+            context = multiprocessing.get_context('spawn')
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=work, args=(sender, function, args), daemon=True)
+            process.start()
+            # Only the worker holds the sending end now, so the pipe is closed once the worker exits
+            sender.close()
+            self.processes.add(process)
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, self.receive, receiver, process)
+            finally:
+                if process.is_alive():
+                    process.terminate()
+                    # Nothing it was doing goes on once this returns
+                    await loop.run_in_executor(None, process.join)
+                self.processes.discard(process)
+
+    @staticmethod
+    def receive(receiver, process):
+        """
+        Waits for the result of a worker process, in a thread
+        """
+        try:
+            succeeded, result = receiver.recv()
+        except EOFError:
+            process.join()
+            raise WorkerError(f'Worker process exited with code {process.exitcode} without a result') from None
+        finally:
+            receiver.close()
+        process.join()
+        if not succeeded:
+            raise result
+        return result
+
+    def shutdown(self):
+        """
+        Stops all workers, a training that is stopped halfway leaves the previous snapshot as it was
+        """
+        for process in list(self.processes):
+            process.terminate()
+            process.join()
@@ -0,0 +1,79 @@
+import re
+import functools
+
+# Mentions to users are formatted like so: <@546527580715745290> (or <@!546527580715745290> when using a nickname)
+# Mentions to roles are formatted like so: <@&546527580715745290>
+MENTION = re.compile(r'<@([!&]?)(\d+)>|@everyone|@here')
+
+
+def escape(text: str) -> str:
+    """
+    Wraps @everyone and @here in in-line code so they don't mention anyone
+    """
+    return text.replace('@everyone', '`@everyone`').replace('@here', '`@here`')
+
+
+class MentionRewriter:
+    """
+    Replaces all mentions to other users or roles in messages with just the names of the user or role the mention
+    was referring to, and wraps @everyone and @here in in-line code so they don't mention anyone
+
+    The whole message is rewritten in a single pass of one regex. Names are looked up once and then kept in memory,
+    the cached names are forgotten when Discord tells the bot that a user or role changed
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_names = {}
+        self.role_names = {}
+
+        bot.add_listener(self.on_user_update, 'on_user_update')
+        bot.add_listener(self.on_user_update, 'on_member_update')
+        bot.add_listener(self.on_member_change, 'on_member_join')
+        bot.add_listener(self.on_member_change, 'on_member_remove')
+        bot.add_listener(self.on_role_change, 'on_guild_role_create')
+        bot.add_listener(self.on_role_change, 'on_guild_role_delete')
+        bot.add_listener(self.on_role_update, 'on_guild_role_update')
+
+    def clean(self, content: str, channel_id: int) -> str:
+        if '@' not in content:
+            return content
+        return MENTION.sub(functools.partial(self.replace, channel_id=channel_id), content)
+
+    def replace(self, match, channel_id: int) -> str:
+        kind, mention_id = match.groups()
+        if mention_id is None:
+            return f'`{match.group()}`'
+        if kind == '&':
+            return self.role_name(int(mention_id), channel_id)
+        return self.user_name(int(mention_id))
+
+    def user_name(self, user_id: int) -> str:
+        name = self.user_names.get(user_id)
+        if name is None:
+            user = self.bot.get_user(user_id)
+            name = self.user_names[user_id] = escape(user.display_name) if user else ''
+        return name
+
+    def role_name(self, role_id: int, channel_id: int) -> str:
+        name = self.role_names.get(role_id)
+        if name is None:
+            channel = self.bot.get_channel(channel_id)
+            role = channel.guild.get_role(role_id) if channel else None
+            name = escape(role.name) if role else ''
+            # Role ids are unique across guilds, but a role mentioned from an unknown channel may still exist
+            if channel:
+                self.role_names[role_id] = name
+        return name
+
+    async def on_user_update(self, before, after):
+        self.user_names.pop(after.id, None)
+
+    async def on_member_change(self, member):
+        self.user_names.pop(member.id, None)
+
+    async def on_role_change(self, role):
+        self.role_names.pop(role.id, None)
+
+    async def on_role_update(self, before, after):
+        self.role_names.pop(after.id, None)
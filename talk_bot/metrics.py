@@ -0,0 +1,219 @@
+"""
+Runtime metrics of the bot, in the Prometheus text format
+
+Metrics are counters, gauges and histograms of durations (in seconds) kept in memory. They are served at
+http://<metrics_host>:<metrics_port>/metrics when 'metrics_port' is set, and summarized by the !stats command
+"""
+import math
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+
+from aiohttp import web
+
+# All metrics by name, in the order they were created
+METRICS = {}
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        METRICS[name] = self
+
+    def samples(self):
+        """
+        Yields the name (with labels) and value of every sample of the metric
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name} {format_value(value)}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+    return str(value)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, either increased by hand or read from 'function' every time it's rendered
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, function=None):
+        super().__init__(name, description)
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.function() if self.function is not None else self.value
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, either set by hand or read from 'function' every time it's rendered
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, function=None):
+        super().__init__(name, description)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.function() if self.function is not None else self.value
+
+
+class Histogram(Metric):
+    """
+    Counts of durations (or other values) by the smallest bucket bound they fit in, with their count and sum
+    """
+    kind = 'histogram'
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name: str, description: str, buckets: tuple = BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+        # The last count is of the values larger than every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """
+        Returns a context manager (or decorator, for functions and coroutine functions) that observes the seconds
+        it took to run the code inside it
+        """
+        return Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket that holds the 'q' quantile of the observed values, infinite if it's
+        larger than every bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', seen
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', self.count
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+    def __call__(self, function):
+        observe = self.histogram.observe
+        perf_counter = time.perf_counter
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    observe(perf_counter() - start)
+        else:
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    observe(perf_counter() - start)
+        return timed
+
+
+MESSAGES_RECEIVED = Counter('talk_bot_messages_received_total', 'Messages received from Discord')
+MESSAGES_ADDED = Counter('talk_bot_messages_added_total', 'Received messages that were valid to be stored')
+ON_MESSAGE = Histogram('talk_bot_on_message_seconds', 'Time handling a received message, commands included')
+ADD_MESSAGE = Histogram('talk_bot_add_message_seconds', 'Time validating, buffering and learning a received message')
+BUFFER_FLUSH = Histogram('talk_bot_buffer_flush_seconds', 'Time inserting a flush of the message buffer')
+STORE_HISTORY = Histogram('talk_bot_store_history_seconds', 'Time storing and learning a page of channel history')
+HISTORY_STORED = Counter('talk_bot_history_messages_total', 'Messages of channel histories stored')
+POPULATE_DB = Histogram('talk_bot_populate_db_seconds', 'Time downloading the history of all channels')
+CLEAN_DB = Histogram('talk_bot_clean_db_seconds', 'Time cleaning the whole database')
+COMPACTION = Histogram('talk_bot_compaction_seconds', 'Time archiving and deleting expired messages')
+MESSAGES_COMPACTED = Counter('talk_bot_messages_compacted_total', 'Expired messages archived and deleted')
+DB_CALL = Histogram('talk_bot_db_call_seconds', 'Time waiting for and running a call in a database worker thread')
+CHAIN_LOAD = Histogram('talk_bot_chain_load_seconds', 'Time loading a Markov chain partition, training included')
+MAKE_PHRASE = Histogram('talk_bot_make_phrase_seconds', 'Time making up a phrase')
+PHRASES_REJECTED = Counter('talk_bot_phrases_rejected_total', 'Phrases made up that were not valid to be sent')
+SEND = Histogram('talk_bot_send_seconds', 'Time sending a message to Discord, rate limit waits included')
+SEND_FAILURES = Counter('talk_bot_send_failures_total', 'Messages that could not be sent to Discord')
+SENDS_COALESCED = Counter('talk_bot_sends_coalesced_total', 'Messages sent together with an earlier one')
+LOOP_LAG = Histogram('talk_bot_event_loop_lag_seconds', 'How late the event loop runs a task that is ready')
+
+
+def render() -> str:
+    """
+    Returns all metrics in the Prometheus text format
+    """
+    return '\n'.join(metric.render() for metric in METRICS.values()) + '\n'
+
+
+async def watch_loop_lag(interval: float = 1):
+    """
+    Samples the lag of the event loop every 'interval' seconds, as how late it wakes up from a sleep
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+async def serve(host: str = '127.0.0.1', port: int = 9100) -> web.AppRunner:
+    """
+    Serves the metrics at http://<host>:<port>/metrics, returns the runner of the server to clean it up with
+    """
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
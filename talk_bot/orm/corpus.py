@@ -0,0 +1,85 @@
+"""
+Streaming reads of the messages stored in the bot's database
+
+Messages are read in batches with keyset pagination, every batch is a separate query for the next 'batch_size'
+messages after the last one read, ordered by an indexed column. Only the requested columns are selected, as plain
+tuples, so reading the whole table never holds more than one batch in memory, on Postgres and on Sqlite alike
+
+Reading Message.content also gives the content of messages stored as tokens (see talk_bot.orm.tokens)
+"""
+import peewee
+
+from talk_bot.orm import tokens
+from talk_bot.orm.models import Message
+
+
+def select(*fields: peewee.Field, key: peewee.Field = Message.message_id, after: int = 0,
+           channel_ids: list = None) -> peewee.Query:
+    """
+    Query of 'key' and 'fields' of all messages whose 'key' is higher than 'after', only from the given channels
+    unless 'channel_ids' is None
+    """
+    query = Message.select(key, *fields).where(key > after)
+    if channel_ids is not None:
+        query = query.where(Message.channel_id.in_(channel_ids))
+    return query
+
+
+def read_batch(*fields: peewee.Field, key: peewee.Field = Message.message_id, after: int = 0,
+               channel_ids: list = None, batch_size: int = 1000, decode: bool = True) -> list:
+    """
+    Returns a (key, *fields) tuple for each of the first 'batch_size' messages after 'after', see select
+
+    If Message.content is one of the fields the content of messages stored as tokens is joined back together,
+    unless 'decode' is False
+    """
+    content = next((i for i, field in enumerate(fields) if field is Message.content), None)
+    if content is None or not decode:
+        query = select(*fields, key=key, after=after, channel_ids=channel_ids)
+        return list(query.order_by(key).limit(batch_size).tuples())
+    fields = fields[:content + 1] + (Message.tokens,) + fields[content + 1:]
+    query = select(*fields, key=key, after=after, channel_ids=channel_ids)
+    # Column 0 is the key
+    return tokens.decode(list(query.order_by(key).limit(batch_size).tuples()), content + 1)
+
+
+def read_batches(*fields: peewee.Field, key: peewee.Field = Message.message_id, after: int = 0,
+                 channel_ids: list = None, batch_size: int = 1000, decode: bool = True):
+    """
+    Yields every batch of messages after 'after', see read_batch
+    """
+    while True:
+        batch = read_batch(
+            *fields, key=key, after=after, channel_ids=channel_ids, batch_size=batch_size, decode=decode
+        )
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1][0]
+
+
+def read_messages(after_id: int = 0, channel_ids: list = None, batch_size: int = 1000):
+    """
+    Yields the Discord id and content of every message with a Discord id higher than 'after_id', in order
+    """
+    for batch in read_batches(Message.content, after=after_id, channel_ids=channel_ids, batch_size=batch_size):
+        yield from batch
+
+
+def read_tokens(after_id: int = 0, channel_ids: list = None, batch_size: int = 1000):
+    """
+    Yields the Discord id, content and token ids of every message with a Discord id higher than 'after_id', in
+    order, without joining the tokens back together. The content is None for messages stored as tokens, the token
+    ids are None for messages stored as text
+
+    The words of all token ids yielded are cached in talk_bot.orm.tokens.words
+    """
+    for batch in read_batches(
+        Message.content, Message.tokens, after=after_id, channel_ids=channel_ids, batch_size=batch_size,
+        decode=False
+    ):
+        token_ids = {row[0]: tokens.unpack(row[2]) for row in batch if row[1] is None}
+        tokens.load_words(token_id for message_ids in token_ids.values() for token_id in message_ids)
+        for message_id, content, packed in batch:
+            yield message_id, content, token_ids.get(message_id)
@@ -0,0 +1,41 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from talk_bot import metrics
+from talk_bot.orm.models import db
+
+
+class DatabaseExecutor:
+    """
+    Runs blocking peewee queries in a pool of worker threads, so the bot's event loop never waits on the database
+
+    Every call runs inside its own connection context, taking a connection from the database's connection pool
+    and giving it back once done. At most 'pool_size' calls run at the same time and at most 'queue_depth' more
+    wait for a free worker, other callers wait until there's room in the queue
+    """
+
+    def __init__(self, pool_size: int = 4, queue_depth: int = 100):
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+        self.slots = asyncio.Semaphore(pool_size + queue_depth)
+
+    @metrics.DB_CALL.time()
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) in a worker thread with a database connection and returns its result
+        """
+        async with self.slots:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(self.call, function, *args, **kwargs))
+
+    @staticmethod
+    def call(function, *args, **kwargs):
+        with db.connection_context():
+            return function(*args, **kwargs)
+
+    def shutdown(self):
+        """
+        Waits for all pending calls to finish and closes all pooled connections
+        """
+        self.executor.shutdown(wait=True)
+        db.close_all()
@@ -0,0 +1,81 @@
+"""
+Migrations of the bot's database schema, for both Postgres and Sqlite databases
+
+Every migration is a function that receives a playhouse.migrate.SchemaMigrator and changes the schema from the
+previous version to the next one, MIGRATIONS[0] migrates a database from version 0 (a database created before
+migrations existed) to version 1, and so on. The current version is stored in the SchemaVersion table
+
+New databases are created straight away with the latest schema from the models, so every migration must leave
+the schema exactly like the models would create it, including index names
+"""
+import peewee
+from playhouse.migrate import SchemaMigrator, migrate
+
+from talk_bot.orm.models import db, Message, Token, IgnoredChannel, BackfillCursor, SchemaVersion
+
+MODELS = [Message, Token, IgnoredChannel, BackfillCursor]
+
+
+def add_indexes(migrator: SchemaMigrator):
+    """
+    Indexes the columns used to look up messages and ignored channels
+    """
+    # Ignored channels were not unique before, only one row of each channel is kept
+    first_rows = IgnoredChannel.select(peewee.fn.MIN(IgnoredChannel.id)).group_by(IgnoredChannel.channel_id)
+    IgnoredChannel.delete().where(IgnoredChannel.id.not_in(first_rows)).execute()
+    migrate(
+        migrator.add_index(Message._meta.table_name, ('author_id',), False),
+        migrator.add_index(Message._meta.table_name, ('channel_id', 'message_id'), False),
+        migrator.add_index(IgnoredChannel._meta.table_name, ('channel_id',), True),
+    )
+
+
+def add_tokens(migrator: SchemaMigrator):
+    """
+    Adds the table of tokens and the column of token ids of messages stored as tokens, whose content is NULL
+    (see talk_bot.orm.tokens)
+    """
+    db.create_tables([Token])
+    migrate(
+        migrator.add_column(Message._meta.table_name, 'tokens', Message.tokens),
+        migrator.drop_not_null(Message._meta.table_name, 'content'),
+    )
+
+
+MIGRATIONS = [add_indexes, add_tokens]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def migrate_database() -> int:
+    """
+    Creates the bot's tables if they don't exist yet and applies any pending migration, each in its own transaction
+
+    Databases already at the latest version are left as they are after reading their version, without checking
+    every table
+
+    Returns the number of migrations applied
+    """
+    with db.connection_context():
+        if SchemaVersion.table_exists():
+            marker = SchemaVersion.get_or_none()
+            if marker is not None and marker.version == LATEST_VERSION:
+                return 0
+        db.create_tables([SchemaVersion])
+        marker = SchemaVersion.get_or_none()
+        if marker is None:
+            # Databases created before migrations existed already have the messages table
+            version = 0 if Message.table_exists() else LATEST_VERSION
+            marker = SchemaVersion.create(version=version)
+
+        applied = 0
+        migrator = SchemaMigrator.from_database(db)
+        for version in range(marker.version, LATEST_VERSION):
+            with db.atomic():
+                MIGRATIONS[version](migrator)
+                marker.version = version + 1
+                marker.save()
+            applied += 1
+
+        # New tables are created with the latest schema, existing ones are left as they are
+        db.create_tables(MODELS)
+    return applied
@@ -2,38 +2,93 @@ import json
 
 import peewee
 import os
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-with open(os.path.join(BASE_DIR, 'orm', 'db_credentials.json'), 'r') as f:
-    credentials = json.load(f)
+# The credentials file can be moved elsewhere with the TALK_BOT_DB_CREDENTIALS environment variable
+CREDENTIALS_PATH = os.environ.get('TALK_BOT_DB_CREDENTIALS', os.path.join(BASE_DIR, 'orm', 'db_credentials.json'))
 
-db = peewee.PostgresqlDatabase(
-    credentials['name'],
-    user=credentials['user'],
-    password=credentials['password'],
-    host=credentials['host'],
-    port=credentials['port']
-)
+with open(CREDENTIALS_PATH, 'r') as f:
+    credentials = json.load(f)
 
-# Uncomment the line below if you wish to use Sqlite instead of Postgres for the bot's database
-# db = peewee.SqliteDatabase('bot.db')
+# Connections are pooled, so queries run by the bot's database worker threads (see talk_bot.orm.executor)
+# reuse connections instead of opening a new one every time
+if credentials.get('sqlite'):
+    # Path of a Sqlite database file, used instead of Postgres
+    db = PooledSqliteDatabase(
+        credentials['sqlite'],
+        max_connections=credentials.get('max_connections', 8),
+        stale_timeout=300,
+        check_same_thread=False
+    )
+else:
+    db = PooledPostgresqlDatabase(
+        credentials['name'],
+        user=credentials['user'],
+        password=credentials['password'],
+        host=credentials['host'],
+        port=credentials['port'],
+        max_connections=credentials.get('max_connections', 8),
+        stale_timeout=300
+    )
 
 
 class Message(peewee.Model):
     message_id = peewee.BigIntegerField(null=True, unique=True)
-    content = peewee.TextField()
+    # NULL for messages stored as tokens, see talk_bot.orm.tokens
+    content = peewee.TextField(null=True)
     author_name = peewee.CharField()
-    author_id = peewee.BigIntegerField()
+    author_id = peewee.BigIntegerField(index=True)
     channel_id = peewee.BigIntegerField(null=True)
     timestamp = peewee.DateTimeField(null=True)
+    # Packed ids of the words of messages stored as tokens, last as it was added by a migration
+    tokens = peewee.BlobField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            # Also used for lookups by channel_id alone
+            (('channel_id', 'message_id'), False),
+        )
+
+
+class Token(peewee.Model):
+    """
+    A distinct word of the messages stored as tokens, see talk_bot.orm.tokens
+    """
+    text = peewee.TextField(unique=True)
 
     class Meta:
         database = db
 
 
 class IgnoredChannel(peewee.Model):
-    channel_id = peewee.BigIntegerField()
+    channel_id = peewee.BigIntegerField(unique=True)
+
+    class Meta:
+        database = db
+
+
+class BackfillCursor(peewee.Model):
+    """
+    How far the history of a channel was downloaded into the database, see talk_bot.tasks.backfill
+    """
+    channel_id = peewee.BigIntegerField(unique=True)
+    oldest_id = peewee.BigIntegerField(null=True)
+    newest_id = peewee.BigIntegerField(null=True)
+    fetched = peewee.IntegerField(default=0)
+    complete = peewee.BooleanField(default=False)
+
+    class Meta:
+        database = db
+
+
+class SchemaVersion(peewee.Model):
+    """
+    Version of the database schema, see talk_bot.orm.migrations
+    """
+    version = peewee.IntegerField()
 
     class Meta:
         database = db
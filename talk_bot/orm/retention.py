@@ -0,0 +1,93 @@
+"""
+Retention policy of the messages stored in the bot's database
+
+A message expires once it's older than 'max_age', or once there are more than 'max_per_channel' newer messages in
+its channel or 'max_per_author' newer messages by its author, whatever happens first (every limit is optional).
+Expired messages are folded into the archives of the bot's Markov chains and then deleted, see
+talk_bot.markov.training.compact
+"""
+import datetime
+import operator
+import functools
+from array import array
+
+import peewee
+
+from talk_bot.orm import tokens
+from talk_bot.orm.models import db, Message
+
+
+class RetentionPolicy:
+    def __init__(self, max_age: datetime.timedelta = None, max_per_channel: int = None, max_per_author: int = None):
+        self.max_age = max_age
+        self.max_per_channel = max_per_channel
+        self.max_per_author = max_per_author
+
+    def __bool__(self):
+        return bool(self.max_age or self.max_per_channel or self.max_per_author)
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        """
+        Reads the policy from the 'retention_max_age' (in days), 'retention_max_per_channel' and
+        'retention_max_per_author' settings, a missing or empty setting is no limit
+        """
+        max_age = settings.get('retention_max_age')
+        max_per_channel = settings.get('retention_max_per_channel')
+        max_per_author = settings.get('retention_max_per_author')
+        return cls(
+            max_age=datetime.timedelta(days=float(max_age)) if max_age else None,
+            max_per_channel=int(max_per_channel) if max_per_channel else None,
+            max_per_author=int(max_per_author) if max_per_author else None
+        )
+
+    @staticmethod
+    def beyond(column: peewee.Field, limit: int) -> peewee.Expression:
+        """
+        Condition of the messages that have at least 'limit' newer messages with the same value of 'column'
+        """
+        position = peewee.fn.ROW_NUMBER().over(partition_by=[column], order_by=[Message.message_id.desc()])
+        ranked = Message.select(Message.id, position.alias('position')).alias('ranked')
+        return Message.id.in_(
+            Message.select(ranked.c.id).from_(ranked).where(ranked.c.position > limit)
+        )
+
+    def expired(self) -> peewee.Query:
+        """
+        Query of the id (the primary key, not the Discord id) of every expired message
+        """
+        conditions = []
+        if self.max_age:
+            conditions.append(Message.timestamp < datetime.datetime.utcnow() - self.max_age)
+        if self.max_per_channel:
+            conditions.append(self.beyond(Message.channel_id, self.max_per_channel))
+        if self.max_per_author:
+            conditions.append(self.beyond(Message.author_id, self.max_per_author))
+        return Message.select(Message.id).where(functools.reduce(operator.or_, conditions))
+
+
+def expired_ids(policy: RetentionPolicy) -> array:
+    """
+    Returns the ids of all messages expired under a policy, in order
+    """
+    return array('q', sorted(message_id for message_id, in policy.expired().tuples()))
+
+
+def read_messages(ids: array, batch_size: int = 1000):
+    """
+    Yields batches of the Discord id, channel id and content of the messages with the given ids
+    """
+    for i in range(0, len(ids), batch_size):
+        query = Message.select(Message.message_id, Message.channel_id, Message.content, Message.tokens).where(
+            Message.id.in_(list(ids[i:i + batch_size]))
+        )
+        yield tokens.decode(list(query.tuples()), 2)
+
+
+def delete(ids: array, batch_size: int = 1000):
+    """
+    Deletes the messages with the given ids, all at once
+    """
+    with db.atomic():
+        for i in range(0, len(ids), batch_size):
+            Message.delete().where(Message.id.in_(list(ids[i:i + batch_size]))).execute()
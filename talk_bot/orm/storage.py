@@ -0,0 +1,23 @@
+"""
+Writes of messages to the bot's database, shared by the message buffer and the download of channel histories
+"""
+import peewee
+
+from talk_bot.orm import tokens
+from talk_bot.orm.models import Message
+
+
+def upsert(rows: list, normalized: bool = False) -> list:
+    """
+    Inserts messages ('rows' of Message fields), updating the content of the ones that were already stored.
+    Messages are stored as tokens if 'normalized' (see talk_bot.orm.tokens). Must run with a database connection
+
+    Returns the rows that were stored, only the last one of the rows of the same message is
+    """
+    # Postgres refuses to update the same row twice in one statement, so only the last copy of a message is kept
+    rows = list({row['message_id']: row for row in rows}.values())
+    Message.insert_many(tokens.normalize(rows) if normalized else rows).on_conflict(
+        conflict_target=(Message.message_id,),
+        update={Message.content: peewee.EXCLUDED.content, Message.tokens: peewee.EXCLUDED.tokens}
+    ).execute()
+    return rows
@@ -0,0 +1,116 @@
+"""
+Normalized storage of the content of messages
+
+With the 'normalized_storage' setting on, the bot stores the content of new messages as the ids of its words
+instead of as text: every distinct word is stored once in the Token table and each message only keeps the ids of
+its words in Message.tokens, with Message.content left NULL. Ids are packed as the smallest unsigned integers that
+fit the largest id of the message (see pack), and words are given ids in the order they are first stored, so the
+most common words have the smallest ids and most messages take 2 bytes per word
+
+Messages stored as text (before normalized storage was turned on, or whose content can't be split into tokens and
+joined back exactly) are left as they are, readers get the content of both kinds of messages through
+talk_bot.orm.corpus, which joins the words of normalized ones back together
+
+The ids and words of tokens are cached in memory by every process once read or stored, tokens are never deleted
+"""
+import sys
+from array import array
+
+from talk_bot.markov.chain import tokenize
+from talk_bot.orm.models import Token
+
+# Words longer than this are not interned, messages with one of them are stored as text
+MAX_TOKEN_LENGTH = 200
+# Typecodes of the integers ids are packed as, by the first byte of a packed message
+TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+
+# Token ids by word and words by token id, shared by all threads of the process
+ids = {}
+words = {}
+
+
+def pack(token_ids: list) -> bytes:
+    """
+    Packs token ids as little-endian unsigned integers of 1, 2 or 4 bytes (the smallest that fit all of them),
+    after a byte with their size
+    """
+    largest = max(token_ids, default=0)
+    size = 1 if largest < 1 << 8 else 2 if largest < 1 << 16 else 4
+    packed = array(TYPECODES[size], token_ids)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return bytes([size]) + packed.tobytes()
+
+
+def unpack(data: bytes) -> array:
+    # Postgres gives back a memoryview, that array() would read as a sequence of integers
+    token_ids = array(TYPECODES[data[0]])
+    token_ids.frombytes(data[1:])
+    if sys.byteorder != 'little':
+        token_ids.byteswap()
+    return token_ids
+
+
+def can_normalize(content: str) -> bool:
+    """
+    Checks if a message's content can be stored as tokens and joined back into exactly the same content
+    """
+    return '\0' not in content and all(len(word) <= MAX_TOKEN_LENGTH for word in tokenize(content))
+
+
+def intern(new_words: set):
+    """
+    Stores the words that are not in the Token table yet and caches the ids of all of them
+    """
+    missing = [word for word in new_words if word not in ids]
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        # Another thread or process may store the same words at the same time, ids are read back after inserting
+        Token.insert_many([{'text': word} for word in chunk]).on_conflict_ignore().execute()
+        for token_id, word in Token.select(Token.id, Token.text).where(Token.text.in_(chunk)).tuples():
+            ids[word] = token_id
+            words[token_id] = word
+
+
+def load_words(token_ids):
+    """
+    Caches the words of the token ids that are not cached yet
+    """
+    missing = list({token_id for token_id in token_ids if token_id not in words})
+    for i in range(0, len(missing), 500):
+        for token_id, word in Token.select(Token.id, Token.text).where(Token.id.in_(missing[i:i + 500])).tuples():
+            ids[word] = token_id
+            words[token_id] = word
+
+
+def normalize(rows: list) -> list:
+    """
+    Returns copies of rows of Message fields with the content of every message that can be normalized replaced by
+    its tokens, storing any new words in the Token table. Must run with a database connection
+    """
+    normalized = [dict(row, tokens=None) for row in rows]
+    contents = {row['content'] for row in normalized if can_normalize(row['content'])}
+    intern({word for content in contents for word in tokenize(content)})
+    for row in normalized:
+        if row['content'] in contents:
+            row['tokens'] = pack([ids[word] for word in tokenize(row['content'])])
+            row['content'] = None
+    return normalized
+
+
+def decode(rows: list, column: int) -> list:
+    """
+    Returns rows of a query that selected Message.content at 'column' followed by Message.tokens, without the
+    tokens column and with the content of normalized messages joined back together. Must run with a database
+    connection
+    """
+    token_ids = [unpack(row[column + 1]) for row in rows if row[column] is None]
+    load_words(token_id for message_ids in token_ids for token_id in message_ids)
+    decoded = []
+    next_ids = iter(token_ids)
+    for row in rows:
+        content = row[column]
+        if content is None:
+            content = ' '.join([words[token_id] for token_id in next(next_ids)])
+        decoded.append(row[:column] + (content,) + row[column + 2:])
+    return decoded
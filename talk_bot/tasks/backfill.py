@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+import discord
+
+from talk_bot.orm.models import BackfillCursor
+
+
+class Backfill:
+    """
+    Downloads the message history of all text channels the bot can read into the database
+
+    Channels are downloaded concurrently, at most 'concurrency' at a time so the bot doesn't flood Discord's
+    rate limits, and their messages are stored in batches of 'page_size' as they are downloaded. A cursor with the
+    oldest and newest message ids downloaded is saved for every channel after each batch, so the next run only
+    downloads messages newer than the newest one, and older history (up to 'limit' messages per channel) that
+    wasn't downloaded yet
+    """
+
+    def __init__(self, bot, concurrency: int = 4, limit: int = 5_000, page_size: int = 100):
+        self.bot = bot
+        self.limit = limit
+        self.page_size = page_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self):
+        cursors = await self.bot.db_executor.run(
+            lambda: {cursor.channel_id: cursor for cursor in BackfillCursor.select()}
+        )
+        channels = [channel for channel in self.bot.get_all_channels() if isinstance(channel, discord.TextChannel)]
+        await asyncio.gather(*(self.backfill_channel(channel, cursors.get(channel.id)) for channel in channels))
+
+    async def backfill_channel(self, channel: discord.TextChannel, cursor: BackfillCursor = None):
+        async with self.semaphore:
+            if cursor is None:
+                cursor = BackfillCursor(channel_id=channel.id)
+            try:
+                if cursor.newest_id is not None:
+                    # Messages sent since the last backfill, oldest first so the cursor can be saved after each batch
+                    history = channel.history(limit=self.limit, after=discord.Object(id=cursor.newest_id))
+                    await self.download(history, cursor, backwards=False)
+                if not cursor.complete:
+                    # Older messages, until 'limit' messages of this channel were downloaded
+                    before = discord.Object(id=cursor.oldest_id) if cursor.oldest_id is not None else None
+                    remaining = self.limit - cursor.fetched
+                    history = channel.history(limit=remaining, before=before)
+                    downloaded = await self.download(history, cursor, backwards=True)
+                    cursor.complete = downloaded < remaining or cursor.fetched >= self.limit
+                    await self.bot.db_executor.run(cursor.save)
+            except discord.Forbidden:
+                # The bot can't read the history of this channel
+                pass
+            except Exception:
+                logging.exception(f'Failed to download history of channel {channel.id}')
+
+    async def download(self, history: discord.iterators.HistoryIterator, cursor: BackfillCursor,
+                       backwards: bool) -> int:
+        """
+        Stores the valid messages of a channel's history in the database, updating the channel's cursor with the
+        ids of the messages downloaded, 'backwards' tells if the history goes from newer to older messages
+
+        Returns the number of messages downloaded
+        """
+        page = []
+        downloaded = 0
+        async for message in history:
+            downloaded += 1
+            if backwards:
+                cursor.fetched += 1
+            if cursor.newest_id is None or message.id > cursor.newest_id:
+                cursor.newest_id = message.id
+            if cursor.oldest_id is None or message.id < cursor.oldest_id:
+                cursor.oldest_id = message.id
+            if self.bot.is_valid_message(message):
+                page.append({
+                    "message_id": message.id,
+                    "content": self.bot.clean_message(message.content, message.channel.id),
+                    "author_name": message.author.name,
+                    "author_id": message.author.id,
+                    "channel_id": message.channel.id,
+                    "timestamp": message.created_at
+                })
+            if downloaded % self.page_size == 0:
+                await self.store(page, cursor)
+                page = []
+        await self.store(page, cursor)
+        return downloaded
+
+    async def store(self, page: list, cursor: BackfillCursor):
+        if page:
+            await self.bot.store_history(page)
+        await self.bot.db_executor.run(cursor.save)
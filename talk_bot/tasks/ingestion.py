@@ -0,0 +1,123 @@
+import time
+import asyncio
+import logging
+
+from talk_bot import metrics
+from talk_bot.orm import storage
+from talk_bot.orm.executor import DatabaseExecutor
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for the messages the bot receives
+
+    Messages are kept in memory and inserted in the database in bulk, once 'max_size' messages are waiting or
+    'max_delay' seconds after the first one of them was added, whatever happens first. Only one flush runs at a
+    time, messages added meanwhile wait for the next one
+
+    Messages from a flush that failed are put back in the buffer and retried after twice the delay of the last
+    try (up to MAX_BACKOFF seconds), so an unreachable database is not hit for every message received. Past
+    'max_backlog' waiting messages new ones are dropped, so the buffer doesn't grow without bounds meanwhile
+
+    With 'normalized' on, messages are stored as tokens (see talk_bot.orm.tokens)
+    """
+
+    MAX_BACKOFF = 300
+
+    def __init__(self, db_executor: DatabaseExecutor, max_size: int = 100, max_delay: float = 5,
+                 max_backlog: int = 10_000, normalized: bool = False):
+        self.db_executor = db_executor
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_backlog = max_backlog
+        self.normalized = normalized
+        self.rows = []
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.flushing = None
+        # Messages of the flush in progress
+        self.inserting = 0
+        # Flushes that failed in a row
+        self.failures = 0
+        self.dropping = False
+
+        # Metrics
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row: dict):
+        """
+        Adds a message to the buffer, 'row' holds the values of the Message fields
+
+        Returns False if the message was dropped because the buffer is full
+        """
+        if len(self.rows) + self.inserting >= self.max_backlog:
+            if not self.dropping:
+                logging.warning(f'Message buffer is full ({self.max_backlog} messages), dropping new messages')
+                self.dropping = True
+            self.dropped_rows += 1
+            return False
+        self.rows.append(row)
+        if self.failures:
+            # Retried when the last failed flush is retried
+            return True
+        if len(self.rows) >= self.max_size:
+            self.start_flush()
+        else:
+            self.schedule_flush(self.max_delay)
+        return True
+
+    def schedule_flush(self, delay: float):
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(delay, self.start_flush)
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def start_flush(self):
+        """
+        Starts flushing the buffer, unless it's being flushed already
+        """
+        self.cancel_timer()
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Inserts all buffered messages in the database
+        """
+        self.cancel_timer()
+        async with self.lock:
+            if not self.rows:
+                return
+            rows, self.rows = self.rows, []
+            self.inserting = len(rows)
+            start = time.perf_counter()
+            try:
+                await self.db_executor.run(storage.upsert, rows, self.normalized)
+            except Exception:
+                self.failures += 1
+                self.failed_flushes += 1
+                delay = min(self.max_delay * 2 ** self.failures, self.MAX_BACKOFF)
+                logging.exception(f'Failed to insert {len(rows)} buffered messages, retrying in {delay:.0f} seconds')
+                self.rows[:0] = rows
+                self.inserting = 0
+                self.cancel_timer()
+                self.schedule_flush(delay)
+                return
+            metrics.BUFFER_FLUSH.observe(time.perf_counter() - start)
+            self.inserting = 0
+            self.failures = 0
+            self.dropping = False
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            if self.rows:
+                # Messages added while this flush ran
+                self.schedule_flush(0 if len(self.rows) >= self.max_size else self.max_delay)
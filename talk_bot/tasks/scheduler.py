@@ -0,0 +1,181 @@
+import heapq
+import random
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from talk_bot import metrics
+
+# Longest message Discord accepts
+MAX_LENGTH = 2000
+
+
+class Lane:
+    """
+    Messages waiting to be sent to a single destination, and when the last ones were sent
+    """
+
+    def __init__(self, rate: int):
+        self.heap = []
+        self.ready = asyncio.Event()
+        self.sent = deque(maxlen=rate)
+        self.task = None
+
+
+class SendScheduler:
+    """
+    Sends all the bot's messages, so they are sent in order of priority and never faster than Discord allows
+
+    Every destination (a channel or a user) has its own lane: a task that sends its messages one at a time, most
+    urgent first (ERROR, then COMMAND, then CHATTER), and at most 'rate' of them every 'per' seconds, like Discord's
+    bucket of messages of a channel. When the bucket is full the lane waits for it to empty, plus a little jitter so
+    lanes that filled up at the same time don't all send at the same time again. Lanes stop after 'idle_timeout'
+    seconds without messages
+
+    Text messages (without embeds) of the same priority waiting in a lane are sent together as a single message,
+    as long as they fit in one. Sends that fail with a Discord server error are retried up to 'retries' times
+
+    The scheduler also supervises the tasks that produce messages (see SendScheduler.supervise), restarting them
+    when they crash
+    """
+    ERROR = 0
+    COMMAND = 1
+    CHATTER = 2
+
+    def __init__(self, rate: int = 5, per: float = 5, jitter: float = 0.1, retries: int = 3,
+                 idle_timeout: float = 60):
+        self.rate = rate
+        self.per = per
+        self.jitter = jitter
+        self.retries = retries
+        self.idle_timeout = idle_timeout
+        self.lanes = {}
+        self.producers = {}
+        # Keeps messages of the same priority in the order they were sent
+        self.sequence = 0
+
+    def __len__(self):
+        return sum(len(lane.heap) for lane in self.lanes.values())
+
+    def jittered(self, seconds: float) -> float:
+        """
+        Returns 'seconds' give or take 'jitter' of it, so periodic messages of different producers drift apart
+        """
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def send(self, destination: discord.abc.Messageable, content: str = None, *, embed: discord.Embed = None,
+                   priority: int = CHATTER):
+        """
+        Queues a message to a channel or user and waits until it's sent
+
+        Returns the message sent (which may hold other messages coalesced with it), raises the exception of the
+        last try if it couldn't be sent
+        """
+        future = asyncio.get_event_loop().create_future()
+        lane = self.lanes.get(destination.id)
+        if lane is None:
+            lane = self.lanes[destination.id] = Lane(self.rate)
+            lane.task = asyncio.ensure_future(self.run_lane(destination, lane))
+        self.sequence += 1
+        heapq.heappush(lane.heap, (priority, self.sequence, content, embed, [future]))
+        lane.ready.set()
+        return await future
+
+    def coalesce(self, lane: Lane) -> tuple:
+        """
+        Takes the most urgent message out of a lane, together with the text messages of the same priority after it
+        that fit in a single message
+        """
+        priority, sequence, content, embed, futures = heapq.heappop(lane.heap)
+        while embed is None and content is not None and lane.heap:
+            next_priority, _, next_content, next_embed, next_futures = lane.heap[0]
+            if next_priority != priority or next_embed is not None or next_content is None:
+                break
+            if len(content) + 1 + len(next_content) > MAX_LENGTH:
+                break
+            heapq.heappop(lane.heap)
+            content = f'{content}\n{next_content}'
+            futures += next_futures
+            metrics.SENDS_COALESCED.inc()
+        return content, embed, futures
+
+    async def wait_for_bucket(self, lane: Lane):
+        if len(lane.sent) == self.rate:
+            wait = lane.sent[0] + self.per - asyncio.get_event_loop().time()
+            if wait > 0:
+                await asyncio.sleep(wait + random.uniform(0, self.jitter * self.per))
+
+    async def deliver(self, destination: discord.abc.Messageable, lane: Lane, content: str, embed: discord.Embed):
+        """
+        Sends a message once there's room in the lane's bucket, trying again after errors of Discord's servers
+        """
+        attempt = 0
+        while True:
+            await self.wait_for_bucket(lane)
+            try:
+                with metrics.SEND.time():
+                    return await destination.send(content=content, embed=embed)
+            except discord.HTTPException as e:
+                # discord.py already waits out rate limits (429), other client errors would fail again
+                if e.status < 500 or attempt >= self.retries:
+                    raise
+            finally:
+                # Counted from when Discord is done with the message, so a slow send never shortens the window
+                lane.sent.append(asyncio.get_event_loop().time())
+            attempt += 1
+            await asyncio.sleep(self.jittered(2 ** attempt))
+
+    async def run_lane(self, destination: discord.abc.Messageable, lane: Lane):
+        while True:
+            if not lane.heap:
+                lane.ready.clear()
+                try:
+                    await asyncio.wait_for(lane.ready.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # A message may have been queued after the timeout, before the lane got to run again
+                    if not lane.heap:
+                        del self.lanes[destination.id]
+                        return
+                continue
+            content, embed, futures = self.coalesce(lane)
+            try:
+                message = await self.deliver(destination, lane, content, embed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.SEND_FAILURES.inc()
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(message)
+
+    def supervise(self, name: str, factory, restart_delay: float = 60) -> asyncio.Task:
+        """
+        Runs the coroutine made by 'factory' until it returns, making and running a new one 'restart_delay' seconds
+        after it crashes
+        """
+        async def run():
+            while True:
+                try:
+                    await factory()
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logging.exception(f'{name} crashed, restarting it in {restart_delay} seconds')
+                await asyncio.sleep(restart_delay)
+
+        task = self.producers[name] = asyncio.ensure_future(run())
+        return task
+
+    def shutdown(self):
+        """
+        Stops all producers and lanes, messages still waiting are not sent
+        """
+        for task in list(self.producers.values()) + [lane.task for lane in self.lanes.values()]:
+            task.cancel()
@@ -1,43 +1,131 @@
 import asyncio
-import random
+import logging
+from collections import deque
 
 import discord
 
-from talk_bot.orm.models import Message
+from talk_bot import metrics
+from talk_bot.bloom import BloomFilter
+from talk_bot.markov.chain import MarkovChain
+from talk_bot.markov.partitions import ChainPartitions
+from talk_bot.mentions import escape
+from talk_bot.tasks.scheduler import MAX_LENGTH, SendScheduler
 
 
-def make_pairs(data):
-    for i in range(len(data) - 1):
-        yield (data[i], data[i + 1])
+@metrics.MAKE_PHRASE.time()
+def make_phrase(chain: MarkovChain, size: int = 30) -> str:
+    return chain.make_phrase(size)
 
 
-def get_words() -> list:
+class PhraseBuffer:
     """
-    Gets the message content of all messages stored in the bot's database and returns a list
-    of all individual words in those messages
+    Phrases made up from the chain of a scope ahead of time, so sending one never waits for it to be made
+
+    A background task (see PhraseBuffer.fill) keeps up to 'size' phrases in the buffer, making one at a time and
+    letting everything else on the event loop run between them. Only valid phrases are kept, a phrase needs to:
+        - Have at least 'min_words' words, at most 'max_words' and fit in a Discord message
+        - Not mention any user or role
+        - Not be one of the last 'recent' phrases sent
+        - Not be a copy of a stored message, checked against 'copies' (a BloomFilter of the content of all stored
+          messages) if given
+
+    @everyone and @here are wrapped in in-line code so they don't mention anyone
     """
-    messages = Message.select()
-    all_words = [m.content.split(' ') for m in messages]
-    return [word for message in all_words for word in message]
-
-
-def make_phrase(size: int = 30) -> str:
-    words = get_words()
-    pairs = make_pairs(words)
-    word_dict = {}
-    for word_1, word_2 in pairs:
-        if word_1 in word_dict.keys():
-            word_dict[word_1].append(word_2)
+
+    # Phrases made in a row without a valid one before the buffer waits 'retry_delay' seconds to try again
+    MAX_ATTEMPTS = 20
+
+    def __init__(self, chains: ChainPartitions, scope: str = 'global', size: int = 10, min_words: int = 3,
+                 max_words: int = 30, recent: int = 50, copies: BloomFilter = None, retry_delay: float = 60):
+        self.chains = chains
+        self.scope = scope
+        self.size = size
+        self.min_words = min_words
+        self.max_words = max_words
+        self.copies = copies
+        self.retry_delay = retry_delay
+        self.phrases = deque()
+        self.recent = deque(maxlen=recent)
+        self.taken = asyncio.Event()
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def is_valid(self, phrase: str) -> bool:
+        if phrase.count(' ') + 1 < self.min_words or len(escape(phrase)) > MAX_LENGTH:
+            return False
+        if '<@' in phrase:
+            return False
+        if phrase in self.recent or phrase in self.phrases:
+            return False
+        return self.copies is None or phrase not in self.copies
+
+    async def make(self):
+        """
+        Makes up a new phrase, returns None if it's not valid
+        """
+        chain = await self.chains.get(self.scope)
+        phrase = make_phrase(chain, self.max_words)
+        if not self.is_valid(phrase):
+            metrics.PHRASES_REJECTED.inc()
+            return None
+        return phrase
+
+    async def fill(self):
+        """
+        Keeps the buffer full, runs until cancelled
+        """
+        failures = 0
+        while True:
+            if len(self.phrases) >= self.size:
+                self.taken.clear()
+                await self.taken.wait()
+                continue
+            try:
+                phrase = await self.make()
+            except Exception:
+                logging.exception(f'Failed to make a phrase for {self.scope}')
+                phrase = None
+            if phrase is not None:
+                self.phrases.append(phrase)
+                failures = 0
+                await asyncio.sleep(0)
+            else:
+                failures += 1
+                await asyncio.sleep(self.retry_delay if failures >= self.MAX_ATTEMPTS else 0)
+                failures %= self.MAX_ATTEMPTS
+
+    async def pop(self):
+        """
+        Takes the next phrase out of the buffer, or makes up a new one if the buffer is empty
+
+        Returns None if no valid phrase could be made
+        """
+        if self.phrases:
+            phrase = self.phrases.popleft()
         else:
-            word_dict[word_1] = [word_2]
-    chain = [random.choice(words)]
-    for i in range(size):
-        chain.append(random.choice(word_dict[chain[-1]]))
-    return ' '.join(chain)
+            phrase = None
+            for _ in range(self.MAX_ATTEMPTS):
+                phrase = await self.make()
+                if phrase is not None:
+                    break
+        self.taken.set()
+        if phrase is None:
+            return None
+        self.recent.append(phrase)
+        return escape(phrase)
 
 
-async def send_messages(channel: discord.TextChannel, delay: int = 5, size: int = 30):
+async def send_messages(scheduler: SendScheduler, channel: discord.TextChannel, phrases: PhraseBuffer,
+                        delay: int = 5):
+    """
+    Sends a phrase to a channel every 'delay' minutes, give or take the scheduler's jitter, runs until cancelled
+    """
     while True:
-        message = make_phrase(size)
-        await channel.send(message)
-        await asyncio.sleep(60 * delay)
+        message = await phrases.pop()
+        if message:
+            try:
+                await scheduler.send(channel, message, priority=SendScheduler.CHATTER)
+            except discord.HTTPException:
+                logging.exception(f'Failed to send a message to channel {channel.id}')
+        await asyncio.sleep(scheduler.jittered(60 * delay))
@@ -0,0 +1,19 @@
+import asyncio
+import tempfile
+
+import pytest
+
+from benchmarks.database import use_sqlite
+
+# Before anything imports talk_bot.orm.models, worker processes inherit the database through the environment
+DIRECTORY = tempfile.mkdtemp()
+use_sqlite(DIRECTORY)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
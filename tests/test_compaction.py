@@ -0,0 +1,130 @@
+import os
+import asyncio
+import datetime
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+from talk_bot.markov import training
+from talk_bot.markov.chain import MarkovChain
+from talk_bot.markov.partitions import ChainPartitions
+from talk_bot.orm import migrations
+from talk_bot.orm.executor import DatabaseExecutor
+from talk_bot.orm.models import db, Message
+from talk_bot.orm.retention import RetentionPolicy
+
+OLD = datetime.datetime(2019, 1, 1)
+NEW = datetime.datetime.utcnow()
+POLICY = RetentionPolicy(max_age=datetime.timedelta(days=1))
+
+
+def store(first_id: int, contents: list, timestamp: datetime.datetime, channel_id: int = 1):
+    with db.connection_context():
+        Message.insert_many([{
+            'message_id': first_id + i,
+            'content': content,
+            'author_name': 'user',
+            'author_id': 1,
+            'channel_id': channel_id,
+            'timestamp': timestamp
+        } for i, content in enumerate(contents)]).execute()
+
+
+def learned(contents: list) -> MarkovChain:
+    chain = MarkovChain()
+    for content in contents:
+        chain.add(content)
+    return chain
+
+
+@pytest.fixture
+def chains(loop):
+    migrations.migrate_database()
+    with db.connection_context():
+        Message.delete().execute()
+    db_executor = DatabaseExecutor()
+    bot = SimpleNamespace(
+        db_executor=db_executor,
+        message_buffer=SimpleNamespace(lock=asyncio.Lock(), rows=[]),
+        get_channel=lambda channel_id: None
+    )
+    yield ChainPartitions(bot, ['channel:1'], snapshot_dir=tempfile.mkdtemp())
+    db_executor.shutdown()
+    with db.connection_context():
+        Message.delete().execute()
+
+
+def test_compaction_keeps_messages_newer_than_snapshot(loop, chains):
+    kept = [f'kept message number {i}' for i in range(5)]
+    expired = [f'expired words {i} gone' for i in range(5)]
+    store(1, kept, NEW)
+    chain = loop.run_until_complete(chains.get('channel:1'))
+    loop.run_until_complete(chains.save())
+    chains.loaded.pop('channel:1')
+    assert chains.watermarks['channel:1'] == 5
+
+    # Stored while the partition isn't loaded, newer than its snapshot
+    store(6, expired, OLD)
+    for i, content in enumerate(expired):
+        chains.add(1, content, 6 + i)
+    assert loop.run_until_complete(chains.compact(POLICY)) == 5
+
+    chain = loop.run_until_complete(chains.get('channel:1'))
+    assert all(word in chain.vocabulary.ids for content in expired for word in content.split())
+    assert chain.total == learned(kept + expired).total
+    assert chain.watermark == 5
+
+
+def stored() -> int:
+    with db.connection_context():
+        return Message.select().count()
+
+
+def test_stopped_compaction_archives_once(loop, chains, monkeypatch):
+    kept = [f'kept message number {i}' for i in range(5)]
+    expired = [f'expired words {i} gone' for i in range(5)]
+    store(1, kept + expired, NEW)
+    loop.run_until_complete(chains.get('channel:1'))
+    with db.connection_context():
+        Message.update(timestamp=OLD).where(Message.message_id > 5).execute()
+
+    def stop(journal: str):
+        # Stops once the archive is written, before any message is deleted
+        if os.path.exists(journal):
+            raise RuntimeError('Stopped')
+
+    monkeypatch.setattr(training, 'finish_compaction', stop)
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(chains.compact(POLICY, half_life=1e12))
+    assert not os.path.exists(chains.journal)
+    assert stored() == 5
+
+    monkeypatch.undo()
+    assert loop.run_until_complete(chains.compact(POLICY, half_life=1e12)) == 0
+    chain = loop.run_until_complete(chains.get('channel:1'))
+    assert chain.total == learned(kept + expired).total
+
+
+def test_stopped_rebuild_resets_watermark(loop, chains, monkeypatch):
+    kept = [f'kept message number {i}' for i in range(5)]
+    expired = [f'expired words {i} gone' for i in range(10)]
+    store(1, kept, NEW)
+    store(6, expired[:5], OLD)
+    loop.run_until_complete(chains.get('channel:1'))
+    assert loop.run_until_complete(chains.compact(POLICY, half_life=1e12)) == 5
+    assert chains.watermarks['channel:1'] == 10
+
+    def stop(*args):
+        raise RuntimeError('Stopped')
+
+    # The archive decays now that it exists, so the snapshot is deleted and rebuilt
+    store(11, expired[5:], OLD)
+    monkeypatch.setattr(training, 'train', stop)
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(chains.compact(POLICY, half_life=1e12))
+    assert chains.watermarks['channel:1'] == 0
+
+    monkeypatch.undo()
+    chain = loop.run_until_complete(chains.get('channel:1'))
+    assert chain.total == learned(kept + expired).total
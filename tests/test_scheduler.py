@@ -0,0 +1,84 @@
+import random
+import asyncio
+
+import discord
+import pytest
+
+from benchmarks.scheduler import FakeResponse, FakeTextChannel, max_in_window
+from talk_bot.tasks.scheduler import MAX_LENGTH, SendScheduler
+
+
+class ScriptedTextChannel(FakeTextChannel):
+    """
+    Fails its first sends with the Discord errors of the given HTTP statuses, then sends everything
+    """
+
+    def __init__(self, channel_id: int, statuses: list):
+        super().__init__(channel_id, failure_rate=0)
+        self.statuses = list(statuses)
+
+    async def send(self, content: str = None, embed=None):
+        if self.statuses:
+            self.failures += 1
+            raise discord.HTTPException(FakeResponse(self.statuses.pop(0)), 'Fake error')
+        return await super().send(content, embed)
+
+
+@pytest.fixture
+def scheduler(loop):
+    # Time scaled down ten times, retries don't wait seconds
+    scheduler = SendScheduler(rate=5, per=0.5, idle_timeout=1)
+    scheduler.jittered = lambda seconds: seconds / 100
+    yield scheduler
+    lanes = [lane.task for lane in scheduler.lanes.values()]
+    scheduler.shutdown()
+    loop.run_until_complete(asyncio.gather(*lanes, return_exceptions=True))
+
+
+def send_all(loop, scheduler: SendScheduler, sends: list) -> list:
+    return loop.run_until_complete(asyncio.gather(*(
+        scheduler.send(channel, content, priority=priority) for channel, priority, content in sends
+    ), return_exceptions=True))
+
+
+def test_bucket_limit(loop, scheduler):
+    channels = [FakeTextChannel(i + 1, failure_rate=0.1) for i in range(3)]
+    sends = [(channel, SendScheduler.CHATTER, f'{i} ' + 'x' * 600) for i in range(30) for channel in channels]
+    send_all(loop, scheduler, sends)
+    for channel in channels:
+        assert len(channel.sent) >= 10
+        assert max_in_window([t for t, _ in channel.sent], scheduler.per) <= scheduler.rate
+
+
+def test_error_before_chatter(loop, scheduler):
+    channel = FakeTextChannel(1, failure_rate=0)
+    sends = [(channel, SendScheduler.CHATTER, f'chatter {i} ' + 'x' * 1500) for i in range(3)]
+    sends.append((channel, SendScheduler.ERROR, 'error'))
+    send_all(loop, scheduler, sends)
+    assert [content.split()[0] for _, content in channel.sent] == ['error', 'chatter', 'chatter', 'chatter']
+
+
+def test_server_errors_retried(loop, scheduler):
+    channel = ScriptedTextChannel(1, [500, 503])
+    assert send_all(loop, scheduler, [(channel, SendScheduler.CHATTER, 'hello')]) == ['hello']
+    assert channel.failures == 2
+    assert [content for _, content in channel.sent] == ['hello']
+
+
+def test_client_errors_raised(loop, scheduler):
+    channel = ScriptedTextChannel(1, [400])
+    result, = send_all(loop, scheduler, [(channel, SendScheduler.CHATTER, 'hello')])
+    assert isinstance(result, discord.HTTPException) and result.status == 400
+    assert channel.failures == 1
+    assert not channel.sent
+
+
+def test_coalesced_messages_fit(loop, scheduler):
+    channel = FakeTextChannel(1, failure_rate=0)
+    contents = [f'{i} ' + 'x' * random.randint(1, 900) for i in range(50)]
+    results = send_all(loop, scheduler, [(channel, SendScheduler.CHATTER, content) for content in contents])
+    sent = [content for _, content in channel.sent]
+    assert len(sent) < len(contents)
+    assert all(len(content) <= MAX_LENGTH for content in sent)
+    assert '\n'.join(sent).split('\n') == contents
+    assert all(content in result.split('\n') for content, result in zip(contents, results))
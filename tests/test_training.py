@@ -0,0 +1,91 @@
+import os
+import time
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.database import fill
+from benchmarks.training import watch_loop
+from talk_bot.markov import snapshot
+from talk_bot.markov.partitions import ChainPartitions
+from talk_bot.markov.training import Trainer, WorkerError
+from talk_bot.orm.executor import DatabaseExecutor
+
+MESSAGES = 20_000
+# Generous, building the chain on the event loop blocks it for seconds
+MAX_LAG = 0.25
+
+
+def die():
+    os._exit(1)
+
+
+def sleep(seconds: float):
+    time.sleep(seconds)
+
+
+class DyingTrainer(Trainer):
+    async def train(self, path: str, order: int, backoff: int, channel_ids: list = None) -> tuple:
+        return await self.run(die)
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    fill(MESSAGES)
+
+
+@pytest.fixture
+def trainer():
+    trainer = Trainer()
+    yield trainer
+    trainer.shutdown()
+
+
+def test_train_keeps_event_loop_running(loop, corpus, trainer):
+    lags = []
+    stop = asyncio.Event()
+    path = os.path.join(tempfile.mkdtemp(), 'global.snapshot')
+
+    async def train():
+        watcher = asyncio.ensure_future(watch_loop(lags, stop))
+        try:
+            return await trainer.train(path, 1, 2)
+        finally:
+            stop.set()
+            await watcher
+
+    words, watermark = loop.run_until_complete(train())
+    assert words > 0
+    assert watermark == MESSAGES
+    assert len(snapshot.load(path)) == words
+    assert lags and max(lags) < MAX_LAG
+
+
+def test_dead_worker_fails_task(loop, trainer):
+    start = time.perf_counter()
+    with pytest.raises(WorkerError):
+        loop.run_until_complete(trainer.run(die))
+    assert time.perf_counter() - start < 30
+    assert not trainer.processes
+
+
+def test_timeout_terminates_worker(loop, trainer):
+    with pytest.raises(asyncio.TimeoutError):
+        loop.run_until_complete(asyncio.wait_for(trainer.run(sleep, 60), 1))
+    assert not trainer.processes
+
+
+def test_partition_loads_without_dead_worker(loop, corpus):
+    db_executor = DatabaseExecutor()
+    trainer = DyingTrainer()
+    bot = SimpleNamespace(db_executor=db_executor, message_buffer=SimpleNamespace(lock=asyncio.Lock(), rows=[]))
+    chains = ChainPartitions(bot, ['global'], snapshot_dir=tempfile.mkdtemp(), trainer=trainer, train_timeout=60)
+    try:
+        chain = loop.run_until_complete(chains.get('global'))
+    finally:
+        trainer.shutdown()
+        db_executor.shutdown()
+    assert chain.watermark == MESSAGES
+    assert len(chain) > 0